@@ -1,5 +1,6 @@
 import os
 import ctypes
+import threading
 import log
 
 
@@ -29,6 +30,8 @@ class BaseMusic:
         self.bits = 0.0
         self.length = 0.0
         self.pitch = 1.0
+        self.finished = threading.Event()
+        self.has_finished_event = False
 
     def play(self) -> None:
         pass
@@ -36,12 +39,23 @@ class BaseMusic:
     def stop(self) -> None:
         pass
 
+    def fade_in(self, ms: int) -> None:
+        self.play()
+
+    def fade_out(self, ms: int) -> None:
+        self.stop()
+
     def set_paused(self, paused: bool) -> None:
         pass
 
     def is_playing(self) -> bool:
         pass
 
+    def is_finished(self) -> bool:
+        if self.has_finished_event:
+            return self.finished.is_set()
+        return not self.is_playing()
+
     def set_volume(self, volume: float = 1.0) -> None:
         pass
 
@@ -61,6 +75,9 @@ class BaseMusic:
 class BaseBackend:
     def __init__(self) -> None:
         self.title = 'Base'
+        self.can_overlap = False
+        # Whether open_music can run on another thread while the main thread uses the backend
+        self.thread_safe = True
 
     def init(self) -> None:
         pass
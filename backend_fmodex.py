@@ -1,5 +1,7 @@
 import sys
+import time
 import ctypes
+import threading
 import backend_base
 import log
 
@@ -283,6 +285,14 @@ class FmodExWrapper(backend_base.BaseWrapper):
         self.FMOD_INIT_THREAD_UNSAFE = 0x00100000
         self.FMOD_INIT_PROFILE_METER_ALL = 0x00200000
         self.FMOD_INIT_MEMORY_TRACKING = 0x00400000
+        # - Channel Callbacks -
+        self.FMOD_CHANNELCONTROL_CALLBACK_END = 0
+        self.FMOD_CHANNELCONTROL_CALLBACK_VIRTUALVOICE = 1
+        self.FMOD_CHANNELCONTROL_CALLBACK_SYNCPOINT = 2
+        self.FMOD_CHANNELCONTROL_CALLBACK_OCCLUSION = 3
+        self.channel_callback_func = (ctypes.WINFUNCTYPE if sys.platform == 'win32' else ctypes.CFUNCTYPE)(
+            ctypes.c_int, ctypes.c_void_p, ctypes.c_int, ctypes.c_int, ctypes.c_void_p, ctypes.c_void_p
+        )
         # - Music Modes -
         self.FMOD_DEFAULT = 0x00000000
         self.FMOD_LOOP_OFF = 0x00000001
@@ -377,6 +387,19 @@ class FmodExWrapper(backend_base.BaseWrapper):
         self.FMOD_System_Update = self.wrap('FMOD_System_Update', args=(ctypes.c_void_p,))
         self.FMOD_Channel_Stop = self.wrap('FMOD_Channel_Stop', args=(ctypes.c_void_p,))
         self.FMOD_Channel_SetPaused = self.wrap('FMOD_Channel_SetPaused', args=(ctypes.c_void_p, ctypes.c_int))
+        self.FMOD_Channel_GetDSPClock = self.wrap('FMOD_Channel_GetDSPClock', args=(
+            ctypes.c_void_p, ctypes.POINTER(ctypes.c_ulonglong), ctypes.POINTER(ctypes.c_ulonglong)
+        ))
+        self.FMOD_Channel_SetDelay = self.wrap('FMOD_Channel_SetDelay', args=(
+            ctypes.c_void_p, ctypes.c_ulonglong, ctypes.c_ulonglong, ctypes.c_int
+        ))
+        self.FMOD_Channel_AddFadePoint = self.wrap('FMOD_Channel_AddFadePoint', args=(
+            ctypes.c_void_p, ctypes.c_ulonglong, ctypes.c_float
+        ))
+        self.FMOD_Channel_RemoveFadePoints = self.wrap('FMOD_Channel_RemoveFadePoints', args=(
+            ctypes.c_void_p, ctypes.c_ulonglong, ctypes.c_ulonglong
+        ))
+        self.FMOD_Channel_SetCallback = self.wrap('FMOD_Channel_SetCallback', args=(ctypes.c_void_p, ctypes.c_void_p))
         self.FMOD_Channel_SetVolume = self.wrap('FMOD_Channel_SetVolume', args=(ctypes.c_void_p, ctypes.c_float))
         self.FMOD_Channel_SetPitch = self.wrap('FMOD_Channel_SetPitch', args=(ctypes.c_void_p, ctypes.c_float))
         self.FMOD_Channel_GetPitch = self.wrap(
@@ -457,15 +480,29 @@ class FmodExMusic(backend_base.BaseMusic):
             'Failed to get sound length'
         )
         self.length = length_buf.value / 1000
+        self.has_finished_event = bool(self.bk.update_thread and self.fmod.FMOD_Channel_SetCallback)
         # We don't need this in the current context
         '''freq_buf = ctypes.c_float(0.0)
         self.bk.check_result_warn(self.fmod.FMOD_Sound_GetDefaults(self.mus, freq_buf, None), 'Failed to get def info')
         self.freq = freq_buf.value'''
 
     def play(self) -> None:
+        self.fade_in(0)
+
+    def fade_in(self, ms: int) -> None:
+        self.finished.clear()
+        # Start paused, so the update thread can't end the channel before the callback is installed
         self.bk.check_result_warn(self.fmod.FMOD_System_PlaySound(
-            self.bk.sys, self.mus, None, 0, self.ch
+            self.bk.sys, self.mus, None, 1, self.ch
         ), 'Failed to play music')
+        if self.has_finished_event and self.ch.value:
+            self.bk.channel_map[self.ch.value] = self
+            self.bk.check_result_warn(
+                self.fmod.FMOD_Channel_SetCallback(self.ch, self.bk.channel_callback), 'Failed to set channel callback'
+            )
+        if ms > 0:
+            self.add_fade(0.0, 1.0, ms)
+        self.bk.check_result_warn(self.fmod.FMOD_Channel_SetPaused(self.ch, self.paused), 'Failed to play music')
         freq_buf = ctypes.c_float(0.0)
         res = self.fmod.FMOD_Channel_GetFrequency(self.ch, freq_buf)
         if res == self.fmod.FMOD_OK:
@@ -481,10 +518,39 @@ class FmodExMusic(backend_base.BaseMusic):
 
     def stop(self) -> None:
         res = self.fmod.FMOD_Channel_Stop(self.ch)
+        self.finished.set()
         if res == self.fmod.FMOD_ERR_INVALID_HANDLE:
             return
         self.bk.check_result_warn(res, 'Failed to stop channel')
 
+    def fade_out(self, ms: int) -> None:
+        # Ramp down and let the mixer stop the channel itself when the ramp ends
+        self.fmod.FMOD_Channel_RemoveFadePoints(self.ch, 0, 0xFFFFFFFFFFFFFFFF)
+        end_clock = self.add_fade(1.0, 0.0, ms)
+        if end_clock is None:
+            self.stop()
+            return
+        res = self.fmod.FMOD_Channel_SetDelay(self.ch, 0, end_clock, 1)
+        if not res == self.fmod.FMOD_OK:
+            self.bk.check_result_warn(res, 'Failed to fade out channel')
+            self.stop()
+
+    def add_fade(self, start_volume: float, end_volume: float, ms: int) -> any:
+        clock_buf = ctypes.c_ulonglong(0)
+        res = self.fmod.FMOD_Channel_GetDSPClock(self.ch, None, clock_buf)
+        if not res == self.fmod.FMOD_OK:
+            if not res == self.fmod.FMOD_ERR_INVALID_HANDLE:
+                self.bk.check_result_warn(res, 'Failed to get channel clock')
+            return None
+        end_clock = clock_buf.value + self.bk.mix_rate * ms // 1000
+        self.bk.check_result_warn(
+            self.fmod.FMOD_Channel_AddFadePoint(self.ch, clock_buf.value, start_volume), 'Failed to add fade point'
+        )
+        self.bk.check_result_warn(
+            self.fmod.FMOD_Channel_AddFadePoint(self.ch, end_clock, end_volume), 'Failed to add fade point'
+        )
+        return end_clock
+
     def is_playing(self) -> bool:
         buf = ctypes.c_int(0)
         res = self.fmod.FMOD_Channel_IsPlaying(self.ch, buf)
@@ -535,6 +601,8 @@ class FmodExMusic(backend_base.BaseMusic):
     def destroy(self) -> None:
         if not self.fmod:
             return
+        if self.ch.value:
+            self.bk.channel_map.pop(self.ch.value, None)
         if self.mus:
             result = self.fmod.FMOD_Sound_Release(self.mus)
             if self.bk.check_result_warn:
@@ -548,12 +616,21 @@ class FmodExBackend(backend_base.BaseBackend):
     def __init__(self, app: any, libs: dict) -> None:
         super().__init__()
         self.title = 'FmodEx'
+        self.can_overlap = True
         self.app = app
         self.header_version = eval(app.config['fmod_version'])
         self.sys = ctypes.c_void_p()
         self.fmod = FmodExWrapper(libs.get('fmod'))
         self.device_names = []
         self.current_device_name = ''
+        self.mix_rate = 48000
+        self.update_rate = app.config['fmod_update_rate']
+        # Without the update thread FMOD is initialized with FMOD_INIT_THREAD_UNSAFE
+        self.thread_safe = self.update_rate > 0
+        self.update_thread = None
+        self.update_running = threading.Event()
+        self.channel_map = {}
+        self.channel_callback = self.fmod.channel_callback_func(self.on_channel_callback)
 
     def init(self) -> None:
         res = self.fmod.FMOD_System_Create(self.sys, self.header_version)
@@ -583,9 +660,20 @@ class FmodExBackend(backend_base.BaseBackend):
         self.check_result_warn(self.fmod.FMOD_System_SetSoftwareFormat(
             self.sys, self.app.config['freq'], mode_buf.value, self.app.config['channels']
         ), 'Failed to set audio specs')
+        # The update thread calls into FMOD alongside the main thread, so it needs the API to be thread safe
+        init_flags = self.fmod.FMOD_INIT_NORMAL if self.update_rate > 0 else self.fmod.FMOD_INIT_THREAD_UNSAFE
         self.check_result_err(self.fmod.FMOD_System_Init(
-            self.sys, 1, self.fmod.FMOD_INIT_THREAD_UNSAFE, None
+            self.sys, 1, init_flags, None
         ), 'Failed to init system')
+        # Fade points and delays are in mixer clock ticks, so they need the rate FMOD actually mixes at
+        rate_buf = ctypes.c_int(0)
+        if self.fmod.FMOD_System_GetSoftwareFormat(
+            self.sys, rate_buf, mode_buf, channels_buf
+        ) == self.fmod.FMOD_OK and rate_buf.value > 0:
+            self.mix_rate = rate_buf.value
+        else:
+            self.mix_rate = self.app.config['freq'] or self.mix_rate
+            log.warn('Failed to get the mixer rate, fades may have the wrong length')
         if self.app.config['audio_driver']:
             if self.fmod.output_map.get(self.app.config['audio_driver']):
                 self.check_result_err(self.fmod.FMOD_System_SetOutput(
@@ -621,6 +709,10 @@ class FmodExBackend(backend_base.BaseBackend):
             self.current_device_name = self.device_names[driver_buf.value]
         except IndexError:
             self.current_device_name = ''
+        if self.update_rate > 0:
+            self.update_running.set()
+            self.update_thread = threading.Thread(target=self.update_loop, daemon=True)
+            self.update_thread.start()
 
     def get_audio_devices_names(self) -> list:
         return self.device_names
@@ -640,6 +732,11 @@ class FmodExBackend(backend_base.BaseBackend):
         return FmodExMusic(self, self.fmod, fp, mus)
 
     def quit(self) -> None:
+        if self.update_thread:
+            self.update_running.clear()
+            self.update_thread.join()
+            self.update_thread = None
+        self.channel_map.clear()
         self.check_result_warn(self.fmod.FMOD_System_Close(self.sys), 'Failed to close system')
         self.check_result_warn(self.fmod.FMOD_System_Release(self.sys), 'Failed to release system')
 
@@ -677,4 +774,27 @@ class FmodExBackend(backend_base.BaseBackend):
         return r_map.get(output_buf.value) or 'none'
 
     def update(self) -> None:
+        if self.update_thread:
+            return
         self.check_result_warn(self.fmod.FMOD_System_Update(self.sys), 'Failed to update system')
+
+    def update_loop(self) -> None:
+        interval = 1.0 / self.update_rate
+        next_time = time.monotonic()
+        while self.update_running.is_set():
+            self.check_result_warn(self.fmod.FMOD_System_Update(self.sys), 'Failed to update system')
+            next_time += interval
+            delay = next_time - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                next_time = time.monotonic()
+
+    def on_channel_callback(self, ch: int, control_type: int, callback_type: int, data1: int, data2: int) -> int:
+        # Called from FMOD_System_Update in the update thread
+        if callback_type == self.fmod.FMOD_CHANNELCONTROL_CALLBACK_END:
+            mus = self.channel_map.pop(ch, None)
+            if mus:
+                mus.finished.set()
+                self.app.server.notify()
+        return self.fmod.FMOD_OK
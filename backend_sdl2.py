@@ -1,8 +1,8 @@
 import sys
 import ctypes
-import subprocess
 import backend_base
 import log
+import tags
 
 
 class SDL2Wrapper(backend_base.BaseWrapper):
@@ -150,6 +150,8 @@ class SDL2MixWrapper(backend_base.BaseWrapper):
         self.Mix_PauseMusic = self.wrap('Mix_PauseMusic')
         self.Mix_ResumeMusic = self.wrap('Mix_ResumeMusic')
         self.Mix_RewindMusic = self.wrap('Mix_RewindMusic')
+        self.music_finished_func = ctypes.CFUNCTYPE(None)
+        self.Mix_HookMusicFinished = self.wrap('Mix_HookMusicFinished', args=(ctypes.c_void_p, ))
 
 
 class SDL2Music(backend_base.BaseMusic):
@@ -162,24 +164,41 @@ class SDL2Music(backend_base.BaseMusic):
         self.type = self.mix.type_map.get(self.mix.Mix_GetMusicType(self.mus)) or 'none'
         self.play_time_start = 0
         self.pause_time_start = 0
+        self.has_finished_event = bool(self.mix.Mix_HookMusicFinished)
         if self.mix.Mix_MusicDuration:
             self.length = self.mix.Mix_MusicDuration(self.mus)
             if self.length <= 0:
                 self.length = 0.0
                 log.warn(f'Failed to get music length ({self.app.bts(self.sdl.SDL_GetError())})')
-        elif self.app.config['allow_ffmpeg']:
-            try:
-                result: str = subprocess.check_output([
-                    'ffprobe', '-i', self.fp, '-show_entries', 'format=duration', '-v', 'quiet'
-                ], shell=False, encoding=self.app.encoding)
-            except Exception as _err:
-                raise RuntimeError(str(_err))
-            self.length = float(result.split('\n')[1].split('=')[-1])
+        else:
+            # Reading the headers is cheap, ffprobe is only needed for files the parser can't handle
+            self.length = tags.read_tags(self.fp)['duration']
+            if not self.length and self.app.durations:
+                # Don't wait for ffprobe here, the length is filled in later if it isn't cached yet
+                self.length = self.app.durations.get(self.fp, self.on_length)
+
+    def on_length(self, length: float) -> None:
+        # Called by the ffprobe pool, the music may be destroyed by now
+        self.length = length
+        app = self.app
+        if app:
+            app.server.notify()
 
     def play(self) -> None:
-        result = self.mix.Mix_PlayMusic(self.mus, 0)
+        self.fade_in(0)
+
+    def fade_in(self, ms: int) -> None:
+        self.finished.clear()
+        self.app.bk.playing_music = self
+        if ms > 0:
+            result = self.mix.Mix_FadeInMusic(self.mus, 0, ms)
+        else:
+            result = self.mix.Mix_PlayMusic(self.mus, 0)
         if result < 0:
             log.warn(f'Failed to play music ({self.app.bts(self.sdl.SDL_GetError())})')
+            # The finished hook is never called for music that didn't start
+            self.finished.set()
+            self.app.server.notify()
         elif not self.mix.Mix_GetMusicPosition:
             self.play_time_start = self.sdl.SDL_GetTicks()
 
@@ -203,6 +222,11 @@ class SDL2Music(backend_base.BaseMusic):
     def stop(self) -> None:
         self.mix.Mix_HaltMusic()
 
+    def fade_out(self, ms: int) -> None:
+        # Halts the music (and calls the finished hook) once the fade is done
+        if not self.mix.Mix_FadeOutMusic(ms):
+            self.stop()
+
     def is_playing(self) -> bool:
         return self.mix.Mix_PlayingMusic()
 
@@ -246,6 +270,8 @@ class SDL2Backend(backend_base.BaseBackend):
         self.sdl = SDL2Wrapper(libs.get('SDL2'), app.is_le)
         self.mix = SDL2MixWrapper(libs.get('SDL2_mixer') or libs.get('SDL2_mixer_ext'))
         self.default_device_name = ''
+        self.playing_music = None
+        self.music_finished_hook = self.mix.music_finished_func(self.on_music_finished)
 
     def init(self) -> None:
         if self.sdl.SDL_AudioInit(self.app.stb(self.app.config['audio_driver']) or None) < 0:
@@ -303,6 +329,15 @@ class SDL2Backend(backend_base.BaseBackend):
         if result < 0:
             raise RuntimeError(f'Failed to open audio device ({self.app.bts(self.sdl.SDL_GetError())})')
         self.mix.Mix_AllocateChannels(0)
+        if self.mix.Mix_HookMusicFinished:
+            self.mix.Mix_HookMusicFinished(self.music_finished_hook)
+
+    def on_music_finished(self) -> None:
+        # Called from the audio thread (or inside Mix_HaltMusic), so only signal the main loop here
+        mus = self.playing_music
+        if mus:
+            mus.finished.set()
+        self.app.server.notify()
 
     def get_audio_devices_names(self) -> list:
         result = []
@@ -328,6 +363,9 @@ class SDL2Backend(backend_base.BaseBackend):
         return SDL2Music(self.app, self.sdl, self.mix, fp, mus)
 
     def quit(self) -> None:
+        if self.mix.Mix_HookMusicFinished:
+            self.mix.Mix_HookMusicFinished(None)
+        self.playing_music = None
         self.mix.Mix_CloseAudio()
         self.mix.Mix_Quit()
         self.sdl.SDL_AudioQuit()
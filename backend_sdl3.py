@@ -1,9 +1,9 @@
 import os
 import sys
 import ctypes
-import subprocess
 import backend_base
 import log
+import tags
 
 
 class SDL3Wrapper(backend_base.BaseWrapper):
@@ -129,6 +129,8 @@ class SDL3MixWrapper(backend_base.BaseWrapper):
         self.Mix_PauseMusic = self.wrap('Mix_PauseMusic')
         self.Mix_ResumeMusic = self.wrap('Mix_ResumeMusic')
         self.Mix_RewindMusic = self.wrap('Mix_RewindMusic')
+        self.music_finished_func = ctypes.CFUNCTYPE(None)
+        self.Mix_HookMusicFinished = self.wrap('Mix_HookMusicFinished', args=(ctypes.c_void_p, ))
 
 
 class SDL3Music(backend_base.BaseMusic):
@@ -141,24 +143,41 @@ class SDL3Music(backend_base.BaseMusic):
         self.type = self.mix.type_map.get(self.mix.Mix_GetMusicType(self.mus)) or 'none'
         self.play_time_start = 0
         self.pause_time_start = 0
+        self.has_finished_event = bool(self.mix.Mix_HookMusicFinished)
         if self.mix.Mix_MusicDuration:
             self.length = self.mix.Mix_MusicDuration(self.mus)
             if self.length <= 0:
                 self.length = 0.0
                 log.warn(f'Failed to get music length ({self.app.bts(self.sdl.SDL_GetError())})')
-        elif self.app.config['allow_ffmpeg']:
-            try:
-                result: str = subprocess.check_output([
-                    'ffprobe', '-i', self.fp, '-show_entries', 'format=duration', '-v', 'quiet'
-                ], shell=False, encoding=self.app.encoding)
-            except Exception as _err:
-                raise RuntimeError(str(_err))
-            self.length = float(result.split('\n')[1].split('=')[-1])
+        else:
+            # Reading the headers is cheap, ffprobe is only needed for files the parser can't handle
+            self.length = tags.read_tags(self.fp)['duration']
+            if not self.length and self.app.durations:
+                # Don't wait for ffprobe here, the length is filled in later if it isn't cached yet
+                self.length = self.app.durations.get(self.fp, self.on_length)
+
+    def on_length(self, length: float) -> None:
+        # Called by the ffprobe pool, the music may be destroyed by now
+        self.length = length
+        app = self.app
+        if app:
+            app.server.notify()
 
     def play(self) -> None:
-        result = self.mix.Mix_PlayMusic(self.mus, 0)
+        self.fade_in(0)
+
+    def fade_in(self, ms: int) -> None:
+        self.finished.clear()
+        self.app.bk.playing_music = self
+        if ms > 0:
+            result = self.mix.Mix_FadeInMusic(self.mus, 0, ms)
+        else:
+            result = self.mix.Mix_PlayMusic(self.mus, 0)
         if not result:
             log.warn(f'Failed to play music ({self.app.bts(self.sdl.SDL_GetError())})')
+            # The finished hook is never called for music that didn't start
+            self.finished.set()
+            self.app.server.notify()
 
     def set_pos(self, pos: float) -> None:
         if not self.mix.Mix_SetMusicPosition(pos):
@@ -174,6 +193,11 @@ class SDL3Music(backend_base.BaseMusic):
     def stop(self) -> None:
         self.mix.Mix_HaltMusic()
 
+    def fade_out(self, ms: int) -> None:
+        # Halts the music (and calls the finished hook) once the fade is done
+        if not self.mix.Mix_FadeOutMusic(ms):
+            self.stop()
+
     def is_playing(self) -> bool:
         return self.mix.Mix_PlayingMusic()
 
@@ -210,6 +234,8 @@ class SDL3Backend(backend_base.BaseBackend):
         self.sdl = SDL3Wrapper(libs.get('SDL3'), app.is_le)
         self.mix = SDL3MixWrapper(libs.get('SDL3_mixer'))
         self.default_device_name = ''
+        self.playing_music = None
+        self.music_finished_hook = self.mix.music_finished_func(self.on_music_finished)
         self.dev_map = {}
 
     def init(self) -> None:
@@ -245,6 +271,15 @@ class SDL3Backend(backend_base.BaseBackend):
         if not result:
             raise RuntimeError(f'Failed to open audio device ({self.app.bts(self.sdl.SDL_GetError())})')
         self.mix.Mix_AllocateChannels(0)
+        if self.mix.Mix_HookMusicFinished:
+            self.mix.Mix_HookMusicFinished(self.music_finished_hook)
+
+    def on_music_finished(self) -> None:
+        # Called from the audio thread (or inside Mix_HaltMusic), so only signal the main loop here
+        mus = self.playing_music
+        if mus:
+            mus.finished.set()
+        self.app.server.notify()
 
     def get_audio_devices_names(self) -> list:
         count = ctypes.c_int(0)
@@ -273,6 +308,9 @@ class SDL3Backend(backend_base.BaseBackend):
         return SDL3Music(self.app, self.sdl, self.mix, fp, mus)
 
     def quit(self) -> None:
+        if self.mix.Mix_HookMusicFinished:
+            self.mix.Mix_HookMusicFinished(None)
+        self.playing_music = None
         self.mix.Mix_CloseAudio()
         self.mix.Mix_Quit()
         self.sdl.SDL_Quit()
@@ -0,0 +1,415 @@
+import gc
+import os
+import sys
+import time
+import array
+import collections
+import struct
+import shutil
+import tempfile
+import threading
+import multiprocessing
+import concurrent.futures
+import main
+import log
+import tags
+import random
+import scanner
+import search
+import weights
+import track_table
+import com_base
+import com_tcp
+import com_udp
+import com_unix
+import socket
+import backend_base
+
+
+class BenchMusic(backend_base.BaseMusic):
+    def __init__(self, server: com_base.BaseServer, length: float, finished_event: bool = False) -> None:
+        super().__init__('bench.mp3')
+        self.server = server
+        self.length = length
+        self.play_time_start = 0.0
+        self.has_finished_event = finished_event
+
+    def play(self) -> None:
+        self.play_time_start = time.monotonic()
+        if self.has_finished_event:
+            threading.Timer(self.length, self.on_finished).start()
+
+    def on_finished(self) -> None:
+        self.finished.set()
+        self.server.notify()
+
+    def stop(self) -> None:
+        self.length = 0.0
+
+    def is_playing(self) -> bool:
+        return time.monotonic() - self.play_time_start < self.length
+
+    def get_pos(self) -> float:
+        return time.monotonic() - self.play_time_start
+
+
+def create_app() -> main.App:
+    app = main.App.__new__(main.App)
+    app.config = {
+        'loop_interval': 0.02,
+        'print_json': False,
+        'print_json_time': False,
+        'formats': ['mp3'],
+        'main_playlist_mode': 'default',
+        'temp_playlist_mode': 'default_pick',
+        'crossfade_ms': 0,
+        'queue_limit': 50
+    }
+    app.server = com_base.BaseServer()
+    app.bk = backend_base.BaseBackend()
+    app.running = True
+    app.tracks = track_table.TrackTable()
+    app.temp_list = collections.deque()
+    app.full_list = array.array('I')
+    app.full_list_group = scanner.TrackGroups()
+    app.removed_tracks = set()
+    app.missing_tracks = []
+    app.validated_tracks = []
+    app.library_watcher = None
+    app.rescan_thread = None
+    app.rescan_result = None
+    app.fading_music = []
+    app.fade_next = False
+    app.prefetch_stale = False
+    app.volume = 1.0
+    app.speed = 1.0
+    app.current_music = None
+    app.event_music = None
+    return app
+
+
+def busy_track_loop(app: main.App) -> None:
+    # The loop as it was before the wakeup event was introduced
+    while app.running and app.current_music and app.current_music.is_playing():
+        app.server.update()
+        app.poll_commands()
+        app.bk.update()
+
+
+def bench_track_loop(duration: float) -> None:
+    for title, loop_func, finished_event in (
+        ('busy', busy_track_loop, False),
+        ('event, polled end', main.App.track_loop, False),
+        ('event, finished hook', main.App.track_loop, True)
+    ):
+        app = create_app()
+        app.current_music = BenchMusic(app.server, duration, finished_event)
+        app.current_music.play()
+        cpu_start = time.process_time()
+        loop_func(app)
+        cpu_time = time.process_time() - cpu_start
+        log.info(f'track_loop ({title}): {cpu_time / duration * 60.0:.3f}s CPU per minute of playback')
+
+
+def vorbis_comment(fields: dict) -> bytes:
+    comments = [f'{_key}={_value}'.encode('utf-8') for _key, _value in fields.items()]
+    return struct.pack('<I', 5) + b'bench' + struct.pack('<I', len(comments)) + b''.join(
+        struct.pack('<I', len(_comment)) + _comment for _comment in comments
+    )
+
+
+def ogg_page(serial: int, seq: int, granule: int, packet: bytes) -> bytes:
+    segments = [255] * (len(packet) // 255) + [len(packet) % 255]
+    return b'OggS\0\0' + struct.pack('<qIII', granule, serial, seq, 0) + bytes([len(segments)]) + bytes(
+        segments
+    ) + packet
+
+
+def mp4_atom(atom_type: bytes, content: bytes) -> bytes:
+    return struct.pack('>I', len(content) + 8) + atom_type + content
+
+
+def make_tag_files(path: str, count: int) -> list:
+    # Minimal but valid headers of every supported container, padded with some fake audio data
+    audio = bytes(16 * 1024)
+    fields = {'ARTIST': 'Bench Artist', 'ALBUM': 'Bench Album', 'TITLE': 'Bench Title'}
+    id3_frames = b''.join(
+        _id + struct.pack('>I', len(_value) + 1) + b'\0\0\3' + _value.encode('utf-8')
+        for _id, _value in ((b'TPE1', fields['ARTIST']), (b'TALB', fields['ALBUM']), (b'TIT2', fields['TITLE']))
+    ) + bytes(512)
+    id3_size = len(id3_frames)
+    id3_size = bytes(((id3_size >> 21) & 0x7F, (id3_size >> 14) & 0x7F, (id3_size >> 7) & 0x7F, id3_size & 0x7F))
+    # MPEG 1 layer 3, 128 kbps, 44100 Hz, joint stereo, with a Xing header of 1000 frames
+    mp3_frame = b'\xff\xfb\x90\x44' + bytes(32) + b'Xing' + struct.pack('>II', 1, 1000)
+    streaminfo = struct.pack('>HH', 4096, 4096) + bytes(6) + (
+        (44100 << 44) | (1 << 41) | (15 << 36) | 44100 * 60
+    ).to_bytes(8, 'big') + bytes(16)
+    comment = vorbis_comment(fields)
+    opus_head = b'OpusHead\1\2' + struct.pack('<HIhB', 312, 48000, 0, 0)
+    mvhd = bytes(12) + struct.pack('>II', 1000, 60000) + bytes(80)
+    mdhd = bytes(12) + struct.pack('>II', 44100, 44100 * 60) + bytes(4)
+    ilst = b''.join(
+        mp4_atom(_type, mp4_atom(b'data', struct.pack('>II', 1, 0) + _value.encode('utf-8')))
+        for _type, _value in (
+            (b'\xa9ART', fields['ARTIST']), (b'\xa9alb', fields['ALBUM']), (b'\xa9nam', fields['TITLE'])
+        )
+    )
+    info = b'INFO' + b''.join(
+        _id + struct.pack('<I', len(_value) + 1) + _value.encode('latin-1') + b'\0' * (2 - len(_value) % 2)
+        for _id, _value in ((b'IART', fields['ARTIST']), (b'IPRD', fields['ALBUM']), (b'INAM', fields['TITLE']))
+    )
+    contents = {
+        'mp3': b'ID3\4\0\0' + id3_size + id3_frames + mp3_frame + audio,
+        'flac': b'fLaC' + b'\0' + len(streaminfo).to_bytes(3, 'big') + streaminfo +
+                b'\x84' + len(comment).to_bytes(3, 'big') + comment + audio,
+        'opus': ogg_page(1, 0, 0, opus_head) + ogg_page(1, 1, 0, b'OpusTags' + comment) + audio +
+                ogg_page(1, 2, 48000 * 60 + 312, bytes(100)),
+        'm4a': mp4_atom(b'ftyp', b'M4A \0\0\0\0') + mp4_atom(b'moov', mp4_atom(b'mvhd', mvhd) + mp4_atom(
+            b'trak', mp4_atom(b'mdia', mp4_atom(b'mdhd', mdhd))
+        ) + mp4_atom(b'udta', mp4_atom(b'meta', bytes(4) + mp4_atom(b'ilst', ilst)))) + mp4_atom(b'mdat', audio),
+        'wav': b'RIFF' + struct.pack('<I', 0) + b'WAVE' + b'fmt ' +
+               struct.pack('<IHHIIHH', 16, 1, 2, 44100, 176400, 4, 16) + b'LIST' + struct.pack('<I', len(info)) +
+               info + b'data' + struct.pack('<I', len(audio)) + audio
+    }
+    exts = tuple(contents)
+    result = []
+    for i in range(count):
+        fp = os.path.join(path, f'{i}.{exts[i % len(exts)]}')
+        f = open(fp, 'wb')
+        f.write(contents[exts[i % len(exts)]])
+        f.close()
+        result.append(fp)
+    return result
+
+
+def bench_tags(count: int) -> None:
+    path = tempfile.mkdtemp(prefix='must_bench_')
+    try:
+        files = make_tag_files(path, count)
+        for fp in files[:5]:
+            log.info(os.path.basename(fp), tags.read_tags(fp))
+        for fp in files:  # Warm the page cache
+            tags.read_tags(fp)
+        start_time = time.perf_counter()
+        for fp in files:
+            tags.read_tags(fp)
+        total_time = time.perf_counter() - start_time
+        log.info(f'read_tags: {count} files in {total_time:.3f}s, {count / total_time:.0f} files/s')
+    finally:
+        shutil.rmtree(path)
+
+
+def synthetic_dirs(track_count: int) -> list:
+    # Ten tracks per album dir, like a tagged library
+    result = []
+    for i in range(0, track_count, 10):
+        dir_prefix = f'/home/user/Music/Artist {i // 100}/Album {i // 10}/'
+        result.append((dir_prefix, tuple(
+            f'{_n + 1:02d} - Artist {i // 100} - Some Song Title {i + _n}.mp3'
+            for _n in range(min(10, track_count - i))
+        )))
+    return result
+
+
+def bench_random_group(group_count: int) -> None:
+    table = track_table.TrackTable()
+    tracks = table.add_dir('/music/', tuple(f'{i % group_count} - {i}.mp3' for i in range(group_count * 3)))
+    groups = scanner.group_tracks(table, tracks)
+    groups_dict = {_key: list(_tracks) for _key, _tracks in groups.items()}
+    picks = 1000
+    start_time = time.perf_counter()
+    for _i in range(picks):
+        random.choice(random.choice(tuple(groups_dict.values())))  # The old way
+    old_time = (time.perf_counter() - start_time) / picks
+    start_time = time.perf_counter()
+    for _i in range(picks * 100):
+        groups.random_track()
+    new_time = (time.perf_counter() - start_time) / picks / 100
+    log.info(f'random_group with {len(groups)} groups: {old_time * 1e6:.2f}us per pick with a tuple of dict values, '
+             f'{new_time * 1e6:.2f}us with TrackGroups')
+
+
+def bench_weighted(track_count: int) -> None:
+    table = track_table.TrackTable()
+    tracks = array.array('I', table.add_dir('/music/', tuple(f'{i}.mp3' for i in range(track_count))))
+    track_weights = weights.TrackWeights(os.devnull)
+    start_time = time.perf_counter()
+    track_weights.rebuild(tracks, table)
+    rebuild_time = time.perf_counter() - start_time
+    picks = 10000
+    start_time = time.perf_counter()
+    for _i in range(picks):
+        track_weights.skip(table.path(tracks[track_weights.pick()]))
+    pick_time = (time.perf_counter() - start_time) / picks
+    log.info(f'weighted with {track_count} tracks: rebuild in {rebuild_time:.3f}s, '
+             f'{pick_time * 1e6:.2f}us per pick and skip')
+
+
+def current_rss() -> int:
+    try:
+        f = open('/proc/self/statm', 'r')
+        rss_pages = int(f.read().split()[1])
+        f.close()
+        return rss_pages * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def library_rss(use_table: bool, track_count: int) -> float:
+    # The scan results are there in both cases, only the playlist structures are measured
+    dirs = synthetic_dirs(track_count)
+    groups = [scanner.group_key(_name) for _dir_prefix, _names in dirs for _name in _names]
+    gc.collect()
+    rss_start = current_rss()
+    if use_table:
+        table = track_table.TrackTable()
+        full_list = array.array('I')
+        for dir_prefix, names in dirs:
+            full_list.extend(table.add_dir(dir_prefix, names))
+        full_list_group = scanner.group_tracks(table, full_list, groups)
+    else:
+        # Full path strings in a list, and a dict of lists of the same strings
+        full_list = []
+        for dir_prefix, names in dirs:
+            full_list.extend(dir_prefix + _name for _name in names)
+        full_list_group = {}
+        for i, fp in enumerate(full_list):
+            full_list_group.setdefault(groups[i], []).append(fp)
+    gc.collect()
+    result = current_rss() - rss_start
+    del full_list, full_list_group
+    return result
+
+
+def bench_track_table(track_count: int) -> None:
+    # Every case gets a fresh process, so memory freed by the previous one doesn't hide the growth
+    for title, use_table in (('list of paths', False), ('track table', True)):
+        with concurrent.futures.ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn')) as executor:
+            rss = executor.submit(library_rss, use_table, track_count).result()
+        log.info(f'{title}: {track_count} tracks take {rss / 2 ** 20:.1f} MB RSS, '
+                 f'{rss / track_count:.1f} bytes per track')
+
+
+def bench_search(track_count: int) -> None:
+    table = track_table.TrackTable()
+    full_list = array.array('I')
+    for dir_prefix, names in synthetic_dirs(track_count):
+        full_list.extend(table.add_dir(dir_prefix, names))
+    groups = scanner.group_tracks(table, full_list)
+    gc.collect()
+    rss_start = current_rss()
+    start_time = time.perf_counter()
+    index = search.SearchIndex(table)
+    index.build(groups)
+    build_time = time.perf_counter() - start_time
+    gc.collect()
+    rss = current_rss() - rss_start
+    log.info(f'search index with {track_count} tracks: built in {build_time:.3f}s, {rss / 2 ** 20:.1f} MB RSS')
+    for query in ('artist 42', f'title {track_count // 2}', 'song title 1234', 'so', 'nothing'):
+        start_time = time.perf_counter()
+        found = index.find(query, groups)
+        find_time = time.perf_counter() - start_time
+        start_time = time.perf_counter()
+        words = query.casefold().split()
+        for fp in table.paths(full_list):  # The old way, looking at every path
+            fp = fp.casefold()
+            all(_word in fp for _word in words)
+        scan_time = time.perf_counter() - start_time
+        log.info(f'"{query}": {len(found)} tracks in {find_time * 1000:.2f}ms, '
+                 f'{scan_time * 1000:.2f}ms with a scan of all paths')
+
+
+def bench_tcp(msg_count: int) -> None:
+    # Clients pipeline framed commands over keep alive connections, the time is until all of them are queued
+    app = create_app()
+    app.config.update({'socket_ip': '127.0.0.1', 'socket_port': 0})
+    server = com_tcp.TCPServer(app)
+    server_addr = server.sock.getsockname()
+    client_count = 4
+    frames = []
+    for i in range(msg_count // client_count):
+        encoded_msg = com_base.BaseServer.encode_msg(f'volume {i % 100 / 100}')
+        frames.append(int.to_bytes(len(encoded_msg), 10, 'little', signed=False) + encoded_msg)
+    keep_alive = com_base.BaseServer.encode_msg('i_want_to_live_please_do\'nt_die')
+    payload = int.to_bytes(len(keep_alive), 10, 'little', signed=False) + keep_alive + b''.join(frames)
+    socks = [socket.create_connection(server_addr) for _i in range(client_count)]
+    total = len(frames) * client_count
+    start_time = time.perf_counter()
+    for sock in socks:
+        threading.Thread(target=sock.sendall, args=(payload, ), daemon=True).start()
+    while len(server.commands) < total:
+        server.wait(1.0)
+    elapsed = time.perf_counter() - start_time
+    for sock in socks:
+        sock.close()
+    server.destroy()
+    log.info(f'tcp: {total} messages from {client_count} clients in {elapsed:.3f}s, {total / elapsed:.0f} messages/s')
+
+
+def percentiles(times: list) -> str:
+    times = sorted(times)
+    return f'median {times[len(times) // 2] * 1e6:.0f}us, p99 {times[int(len(times) * 0.99)] * 1e6:.0f}us'
+
+
+def bench_latency(request_count: int) -> None:
+    # Status round trips on an open connection, and keybinding style commands: connect, send, wait until queued
+    app = create_app()
+    tmp_dir = tempfile.mkdtemp()
+    transports = (
+        ('tcp', com_tcp.TCPServer, com_tcp.TCPClient),
+        ('udp', com_udp.UDPServer, com_udp.UDPClient),
+        ('unix', com_unix.UnixServer, com_unix.UnixClient)
+    )
+    app.config['socket_path'] = os.path.join(tmp_dir, 'bench.sock')
+    for name, server_class, client_class in transports:
+        app.config.update({'socket_ip': '127.0.0.1', 'socket_port': 0})
+        server = server_class(app)
+        if not name == 'unix':
+            app.config['socket_port'] = server.sock.getsockname()[1]
+        server.set_state({'status': {'track': 'bench.mp3', 'paused': False, 'volume': 1.0}})
+        client = client_class(app)
+        client.send('i_want_to_live_please_do\'nt_die')
+        request_times = []
+        for _i in range(request_count):
+            start_time = time.perf_counter()
+            client.request('status')
+            request_times.append(time.perf_counter() - start_time)
+        command_times = []
+        for _i in range(min(request_count, 2000)):
+            start_time = time.perf_counter()
+            command_client = client_class(app)
+            command_client.send('volume 0.5')
+            while not server.commands:
+                server.wait(1.0)
+            command_times.append(time.perf_counter() - start_time)
+            server.commands.clear()
+            command_client.destroy()
+        if name == 'udp':
+            # The UDP server thread only sees that it should stop after the next datagram
+            server.running = False
+            client.sock.sendto(b'', client.server_addr)
+        client.destroy()
+        server.destroy()
+        log.info(f'{name}: request {percentiles(request_times)}; command {percentiles(command_times)}')
+    shutil.rmtree(tmp_dir)
+
+
+benchmarks = {
+    'track_loop': (bench_track_loop, 5.0),
+    'tags': (bench_tags, 10000),
+    'random_group': (bench_random_group, 100000),
+    'weighted': (bench_weighted, 1000000),
+    'track_table': (bench_track_table, 1000000),
+    'search': (bench_search, 1000000),
+    'tcp': (bench_tcp, 1000000),
+    'latency': (bench_latency, 20000)
+}
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or sys.argv[1] not in benchmarks:
+        log.warn('Usage: bench.py', '|'.join(benchmarks), '[size]')
+        sys.exit(1)
+    bench_func, default_size = benchmarks[sys.argv[1]]
+    bench_func(type(default_size)(sys.argv[2]) if len(sys.argv) > 2 else default_size)
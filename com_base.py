@@ -1,14 +1,128 @@
+import json
+import time
+import struct
+import threading
+import collections
+
+
+# Commands that are answered with a JSON result instead of being queued for the main loop
+QUERIES = ('status', 'position', 'queue', 'library_stats')
+# Queries with an argument that need the library, they are answered by the main loop
+LOOP_QUERIES = ('find', )
+
+
+def is_query(msg: str) -> bool:
+    return msg in QUERIES or msg.split(' ')[0] in LOOP_QUERIES
+
+
+class CommandQueue:
+    def __init__(self) -> None:
+        # Any thread can put, only the main loop takes. Deque appends and pops are atomic, the event wakes the loop up.
+        self.items = collections.deque()
+        self.wakeup = threading.Event()
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    def put(self, msg: str) -> None:
+        self.items.append(msg)
+        # The item is in before the check, so a wakeup that is about to be cleared still sees it
+        if not self.wakeup.is_set():
+            self.wakeup.set()
+
+    def notify(self) -> None:
+        self.wakeup.set()
+
+    def wait(self, timeout: float = None) -> None:
+        # Items are added before the event is set, so clearing after the wait can't lose them
+        self.wakeup.wait(timeout)
+        self.wakeup.clear()
+
+    def pop_all(self) -> list:
+        # Only what is queued now, a flood of new commands can't keep the main loop from playing
+        return [self.items.popleft() for _i in range(len(self.items))]
+
+    def clear(self) -> None:
+        self.items.clear()
+
+
 class BaseServer:
     def __init__(self) -> None:
         self.should_kill = False
-        self.commands = []
+        self.commands = CommandQueue()
+        # Replaced as a whole by the main loop, so the I/O threads can answer queries without touching the player
+        self.state = {}
+        # (request id, query, reply) of loop queries, reply takes the encoded response and may be called from any thread
+        self.requests = collections.deque()
 
     def update(self) -> None:
         pass
 
+    def push_command(self, msg: str) -> None:
+        self.commands.put(msg)
+
+    def notify(self) -> None:
+        self.commands.notify()
+
+    def wait(self, timeout: float = None) -> None:
+        self.commands.wait(timeout)
+
     def destroy(self) -> None:
         pass
 
+    def set_state(self, state: dict) -> None:
+        self.state = state
+
+    def has_subscribers(self) -> bool:
+        return False
+
+    def publish(self, event: dict) -> None:
+        pass
+
+    @staticmethod
+    def is_request(msg: str) -> bool:
+        return msg.startswith('?')
+
+    def request(self, msg: str, reply: any) -> bytes:
+        # Returns the response, or nothing when the main loop answers through reply later
+        request_id, _, query = msg[1:].partition(' ')
+        if query.split(' ')[0] in LOOP_QUERIES:
+            self.requests.append((request_id, query, reply))
+            self.notify()
+            return b''
+        return self.answer(msg)
+
+    def pop_requests(self) -> list:
+        return [self.requests.popleft() for _i in range(len(self.requests))]
+
+    def response(self, request_id: str, result: any = None, error: str = None) -> bytes:
+        response = {'id': request_id}
+        if error is None:
+            response['result'] = result
+        else:
+            response['error'] = error
+        return self.encode_msg(json.dumps(response))
+
+    def answer(self, msg: str) -> bytes:
+        # Requests are "?<id> <query>", the response is JSON with the same id
+        request_id, _, query = msg[1:].partition(' ')
+        state = self.state
+        if query not in QUERIES:
+            return self.response(request_id, error=f'Unknown query "{query}"')
+        if query not in state:
+            return self.response(request_id, error='Server is not ready')
+        if query == 'position':
+            # The snapshot may be old, the position moved on since then
+            position = dict(state['position'])
+            if not position['paused'] and position['playing']:
+                position['pos'] += time.monotonic() - position.pop('time')
+                if position['length']:
+                    position['pos'] = min(position['pos'], position['length'])
+            else:
+                position.pop('time')
+            return self.response(request_id, position)
+        return self.response(request_id, state[query])
+
     @staticmethod
     def encode_msg(msg: str) -> bytes:
         return msg.encode('utf-8', errors='replace')  # TODO: compress data maybe?
@@ -18,12 +132,87 @@ class BaseServer:
         return encoded_msg.decode('utf-8', errors='replace')
 
 
+class FrameDecoder:
+    def __init__(self, size: int = 64 * 1024, max_msg_len: int = 1024 * 1024 * 100) -> None:
+        # Frames are a 10 byte little endian length and the body. They are received into one reusable buffer,
+        # the unread part is moved to the start only when the free space at the end runs out.
+        self.size = size
+        self.buf = bytearray(size)
+        self.view = memoryview(self.buf)
+        self.start = 0
+        self.end = 0
+        self.max_msg_len = max_msg_len
+        self.header = struct.Struct('<QH')
+
+    def recv(self, sock: any) -> int:
+        if self.end == len(self.buf):
+            self.make_room(0)
+        read_len = sock.recv_into(self.view[self.end:])
+        self.end += read_len
+        return read_len
+
+    def make_room(self, frame_len: int) -> None:
+        pending = self.end - self.start
+        if frame_len > len(self.buf):
+            buf = bytearray(max(frame_len, len(self.buf) * 2))
+            buf[:pending] = self.view[self.start:self.end]
+            self.view.release()
+            self.buf = buf
+            self.view = memoryview(buf)
+        else:
+            self.view[:pending] = self.view[self.start:self.end]
+        self.start = 0
+        self.end = pending
+
+    def messages(self) -> any:
+        # Yields every complete message, raises ValueError on a frame that is too big
+        while self.end - self.start >= 10:
+            low, high = self.header.unpack_from(self.buf, self.start)
+            msg_len = low | high << 64
+            if msg_len > self.max_msg_len:
+                raise ValueError(f'Message is too big ({msg_len} bytes)')
+            if self.end - self.start - 10 < msg_len:
+                if self.start + 10 + msg_len > len(self.buf):
+                    self.make_room(10 + msg_len)
+                return
+            msg_start = self.start + 10
+            self.start = msg_start + msg_len
+            yield str(self.view[msg_start:self.start], 'utf-8', 'replace')
+        if self.start == self.end:
+            self.start = self.end = 0
+            if len(self.buf) > self.size:  # Don't keep the memory of a huge message
+                self.view.release()
+                self.buf = bytearray(self.size)
+                self.view = memoryview(self.buf)
+
+
 class BaseClient:
     def __init__(self, app: any) -> None:
         self.app = app
+        self.request_id = 0
+        self.timeout = 5.0
 
     def send(self, msg: str) -> None:
         pass
 
+    def request(self, query: str) -> any:
+        return None
+
+    def subscribe(self) -> any:
+        raise RuntimeError('Subscriptions are not supported by this transport')
+
+    def next_request(self, query: str) -> str:
+        self.request_id += 1
+        return f'?{self.request_id} {query}'
+
+    def parse_response(self, msg: str) -> any:
+        # Returns None for responses to other requests
+        response = json.loads(msg)
+        if not response.get('id') == str(self.request_id):
+            return None
+        if 'error' in response:
+            raise RuntimeError(response['error'])
+        return response
+
     def destroy(self) -> None:
         self.app = None
@@ -1,95 +1,298 @@
 import sys
+import json
 import socket
+import collections
+import selectors
 import threading
 import com_base
 
 
+class TCPConnection:
+    def __init__(self, sock: socket.socket) -> None:
+        self.sock = sock
+        self.decoder = com_base.FrameDecoder()
+        # Responses that didn't fit into the socket buffer yet
+        self.out = bytearray()
+        # Without the keep alive message a client sends one command and is disconnected
+        self.keep_alive = False
+        self.closing = False
+        # Requests the main loop didn't answer yet, the connection stays open for them
+        self.pending = 0
+        # Latest position event that is waiting for the older output to be sent, older ones are dropped
+        self.position = None
+
+
 class TCPServer(com_base.BaseServer):
     def __init__(self, app: any) -> None:
         super().__init__()
         self.should_kill = not sys.platform == 'win32'
         self.app = app
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock = self.create_socket()
+        self.sock.listen(128)
+        self.sock.setblocking(False)
+        # Only the I/O thread touches the connections, publish and destroy wake it up through the socket pair
+        self.clients = {}
+        self.subscribers = set()
+        self.events = collections.deque()
+        self.replies = collections.deque()
+        # Subscribers with more unsent output than this are too slow and get disconnected
+        self.max_out = 64 * 1024
+        self.selector = selectors.DefaultSelector()
+        self.wake_r, self.wake_w = socket.socketpair()
+        self.wake_w.setblocking(False)
+        self.selector.register(self.sock, selectors.EVENT_READ)
+        self.selector.register(self.wake_r, selectors.EVENT_READ)
+        self.running = True
+        self.thread = threading.Thread(target=self.io_thread, daemon=True)
+        self.thread.start()
+
+    def create_socket(self) -> socket.socket:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         try:
-            self.sock.bind((app.config['socket_ip'], app.config['socket_port']))
+            sock.bind((self.app.config['socket_ip'], self.app.config['socket_port']))
         except OSError:
+            sock.close()
             raise RuntimeError('Failed to create socket')
-        # self.sock.setblocking(False)
-        self.clients = []
-        self.sock.listen()
-        self.running = True
-        threading.Thread(target=self.accept_clients).start()
+        return sock
 
     def update(self) -> None:
         pass
 
-    def accept_clients(self) -> None:
-        while self.running and self.sock:
-            try:
-                conn, addr = self.sock.accept()
-            except OSError:
-                break
-            self.clients.append(conn)
-            threading.Thread(target=self.client_thread, args=(conn, )).start()
+    def io_thread(self) -> None:
+        try:
+            self.io_loop()
+        finally:
+            # Only this thread selects on the sockets, so it closes them too
+            for client in tuple(self.clients.values()):
+                self.close_client(client)
+            self.selector.close()
+            self.sock.close()
+            self.wake_r.close()
+            self.wake_w.close()
 
-    def client_thread(self, conn: socket.socket) -> None:
-        should_exit = True
+    def io_loop(self) -> None:
         while self.running:
-            try:
-                msg_len_buf = conn.recv(10)
-                if not msg_len_buf:
+            for key, events in self.selector.select():
+                if key.fileobj is self.wake_r:
+                    self.wake_r.recv(4096)
+                    if not self.running:
+                        break
+                    self.deliver_events()
                     continue
-                msg_len = int.from_bytes(msg_len_buf, 'little', signed=False)
-                encoded_msg = conn.recv(msg_len)
-            except OSError:
-                return
-            msg = self.decode_msg(encoded_msg)
-            if should_exit:
-                if msg == 'i_want_to_live_please_do\'nt_die':
-                    should_exit = False
+                if key.fileobj is self.sock:
+                    self.accept_clients()
                     continue
-                self.commands.append(msg)
-                conn.close()
-                if conn in self.clients:
-                    self.clients.remove(conn)
+                if events & selectors.EVENT_READ:
+                    self.read_client(key.data)
+                if events & selectors.EVENT_WRITE and key.data.sock in self.clients:
+                    self.flush_client(key.data)
+
+    def accept_clients(self) -> None:
+        while True:
+            try:
+                conn, addr = self.sock.accept()
+            except OSError:
                 return
-            if msg == 'disconnect':
+            if not self.accept_peer(conn):
                 conn.close()
-                if conn in self.clients:
-                    self.clients.remove(conn)
-                return
-            self.commands.append(msg)
-        # self.should_kill = False
+                continue
+            conn.setblocking(False)
+            client = TCPConnection(conn)
+            self.clients[conn] = client
+            self.selector.register(conn, selectors.EVENT_READ, client)
+
+    def accept_peer(self, conn: socket.socket) -> bool:
+        return True
+
+    def read_client(self, client: TCPConnection) -> None:
+        try:
+            read_len = client.decoder.recv(client.sock)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            read_len = 0
+        if not read_len:  # EOF
+            self.close_client(client)
+            return
+        if client.closing:  # Only waits for its responses
+            return
+        # Messages may arrive in any pieces, a client can also send many of them at once
+        try:
+            for msg in client.decoder.messages():
+                if not self.handle_msg(client, msg):
+                    self.end_client(client)
+                    return
+        except ValueError:
+            self.close_client(client)
+
+    def handle_msg(self, client: TCPConnection, msg: str) -> bool:
+        if self.is_request(msg):
+            encoded_msg = self.request(msg, lambda _encoded_msg: self.reply(client, _encoded_msg))
+            if encoded_msg:
+                self.send_frame(client, encoded_msg)
+            else:
+                client.pending += 1
+            return client.keep_alive
+        if msg == 'subscribe':
+            client.keep_alive = True
+            self.subscribers.add(client)
+            status = self.state.get('status')
+            if status:
+                self.send_frame(client, self.encode_msg(json.dumps(dict(status, event='status'))))
+            # The main loop starts waking up for position events
+            self.notify()
+            return True
+        if not client.keep_alive:
+            if msg == 'i_want_to_live_please_do\'nt_die':
+                client.keep_alive = True
+                return True
+            self.push_command(msg)
+            return False
+        if msg == 'disconnect':
+            return False
+        self.push_command(msg)
+        return True
+
+    def send_frame(self, client: TCPConnection, encoded_msg: bytes) -> None:
+        was_empty = not client.out
+        client.out += int.to_bytes(len(encoded_msg), 10, 'little', signed=False)
+        client.out += encoded_msg
+        if was_empty:
+            self.flush_client(client)
+
+    def flush_client(self, client: TCPConnection) -> None:
+        try:
+            sent = client.sock.send(client.out)
+        except (BlockingIOError, InterruptedError):
+            sent = 0
+        except OSError:
+            self.close_client(client)
+            return
+        del client.out[:sent]
+        if not client.out and client.position:
+            encoded_msg = client.position
+            client.position = None
+            self.send_frame(client, encoded_msg)
+            return
+        if client.out:
+            # Wait until the client reads, the rest of the server doesn't block meanwhile
+            events = selectors.EVENT_WRITE if client.closing else selectors.EVENT_READ | selectors.EVENT_WRITE
+            self.selector.modify(client.sock, events, client)
+        elif client.closing and not client.pending:
+            self.close_client(client)
+        else:
+            self.selector.modify(client.sock, selectors.EVENT_READ, client)
+
+    def end_client(self, client: TCPConnection) -> None:
+        # Unsent and pending responses are still delivered before the connection is closed
+        if not client.out and not client.pending:
+            self.close_client(client)
+            return
+        client.closing = True
+        self.selector.modify(client.sock, selectors.EVENT_WRITE if client.out else selectors.EVENT_READ, client)
+
+    def has_subscribers(self) -> bool:
+        return bool(self.subscribers)
+
+    def publish(self, event: dict) -> None:
+        # Called by the main loop, the I/O thread sends the event to every subscriber
+        self.events.append((event['event'], self.encode_msg(json.dumps(event))))
+        self.wake()
+
+    def reply(self, client: TCPConnection, encoded_msg: bytes) -> None:
+        # Called by the main loop, the I/O thread sends the response
+        self.replies.append((client, encoded_msg))
+        self.wake()
+
+    def wake(self) -> None:
+        try:
+            self.wake_w.send(b'\0')
+        except OSError:  # The socket buffer is full of wakeups already
+            pass
+
+    def deliver_events(self) -> None:
+        while self.replies:
+            client, encoded_msg = self.replies.popleft()
+            client.pending -= 1
+            if client.sock in self.clients:
+                self.send_frame(client, encoded_msg)
+        while self.events:
+            event_type, encoded_msg = self.events.popleft()
+            for client in tuple(self.subscribers):
+                if event_type == 'position' and client.out:
+                    client.position = encoded_msg
+                elif len(client.out) > self.max_out:
+                    self.close_client(client)
+                else:
+                    self.send_frame(client, encoded_msg)
+
+    def close_client(self, client: TCPConnection) -> None:
+        self.subscribers.discard(client)
+        if self.clients.pop(client.sock, None) is None:
+            return
+        self.selector.unregister(client.sock)
+        client.sock.close()
 
     def destroy(self) -> None:
-        for conn in self.clients:
-            conn.close()
-        self.clients.clear()
-        self.running = False
-        if self.sock:
-            self.sock.close()
-            self.sock = None
+        if self.running:
+            self.running = False
+            self.wake()
+            self.thread.join()
+        self.sock = None
         self.app = None
 
 
 class TCPClient(com_base.BaseClient):
     def __init__(self, app: any) -> None:
         super().__init__(app)
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock = self.connect()
+        self.decoder = com_base.FrameDecoder()
+
+    def connect(self) -> socket.socket:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         try:
-            self.sock.connect((app.config['socket_ip'], app.config['socket_port']))
+            sock.connect((self.app.config['socket_ip'], self.app.config['socket_port']))
         except Exception as _err:
+            sock.close()
             raise RuntimeError(str(_err))
+        return sock
 
     def send(self, msg: str) -> None:
         if not msg:
             return
         encoded_msg = com_base.BaseServer.encode_msg(msg)
         try:
-            self.sock.send(int.to_bytes(len(encoded_msg), 10, 'little', signed=False) + encoded_msg)
+            self.sock.sendall(int.to_bytes(len(encoded_msg), 10, 'little', signed=False) + encoded_msg)
         except Exception as _err:
             raise RuntimeError(str(_err))
 
+    def request(self, query: str) -> any:
+        self.send(self.next_request(query))
+        self.sock.settimeout(self.timeout)
+        try:
+            while True:
+                for msg in self.decoder.messages():
+                    response = self.parse_response(msg)
+                    if response:
+                        return response['result']
+                if not self.decoder.recv(self.sock):
+                    raise RuntimeError('Server closed the connection')
+        except (OSError, ValueError) as _err:
+            raise RuntimeError(str(_err))
+        finally:
+            self.sock.settimeout(None)
+
+    def subscribe(self) -> any:
+        self.send('subscribe')
+        try:
+            while True:
+                for msg in self.decoder.messages():
+                    yield json.loads(msg)
+                if not self.decoder.recv(self.sock):
+                    return
+        except (OSError, ValueError) as _err:
+            raise RuntimeError(str(_err))
+
     def destroy(self) -> None:
         super().destroy()
         if self.sock:
@@ -30,9 +30,23 @@ class UDPServer(com_base.BaseServer):
             except OSError:
                 continue
             msg = self.decode_msg(encoded_msg)
-            self.commands.append(msg)
+            if self.is_request(msg):
+                encoded_msg = self.request(msg, lambda _encoded_msg, _addr=new_addr: self.send_to(_encoded_msg, _addr))
+                if encoded_msg:
+                    self.send_to(encoded_msg, new_addr)
+                continue
+            self.push_command(msg)
         # self.should_kill = False
 
+    def send_to(self, encoded_msg: bytes, addr: tuple) -> None:
+        sock = self.sock
+        if not sock:
+            return
+        try:
+            sock.sendto(encoded_msg, addr)
+        except OSError:
+            pass
+
     def destroy(self) -> None:
         self.running = False
         if self.sock:
@@ -56,6 +70,20 @@ class UDPClient(com_base.BaseClient):
         except Exception as _err:
             raise RuntimeError(str(_err))
 
+    def request(self, query: str) -> any:
+        self.send(self.next_request(query))
+        self.sock.settimeout(self.timeout)
+        try:
+            while True:
+                encoded_msg, addr = self.sock.recvfrom(65536)
+                response = self.parse_response(com_base.BaseServer.decode_msg(encoded_msg))
+                if response:
+                    return response['result']
+        except (OSError, ValueError) as _err:
+            raise RuntimeError(str(_err))
+        finally:
+            self.sock.settimeout(None)
+
     def destroy(self) -> None:
         super().destroy()
         if self.sock:
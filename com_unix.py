@@ -0,0 +1,120 @@
+import os
+import stat
+import socket
+import struct
+import tempfile
+import log
+import com_tcp
+
+
+def socket_path(config: dict) -> str:
+    if config['socket_path']:
+        return config['socket_path']
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime_dir and os.path.isdir(runtime_dir):
+        return os.path.join(runtime_dir, 'must.sock')
+    return os.path.join(tempfile.gettempdir(), f'must-{os.getuid()}.sock')
+
+
+def peer_uid(conn: socket.socket) -> tuple:
+    # (pid, uid) of the other end, None where the platform can't tell
+    if not hasattr(socket, 'SO_PEERCRED'):
+        return None
+    pid, uid, gid = struct.unpack('3i', conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, 12))
+    return pid, uid
+
+
+class UnixServer(com_tcp.TCPServer):
+    # Same framing, I/O thread and subscriptions as TCP, without the TCP stack and without a port other users can reach
+    def __init__(self, app: any) -> None:
+        self.path = ''
+        self.inode = 0
+        super().__init__(app)
+
+    def create_socket(self) -> socket.socket:
+        if not hasattr(socket, 'AF_UNIX'):
+            raise RuntimeError('Unix sockets are not supported')
+        path = socket_path(self.app.config)
+        self.remove_stale(path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # Other users can't connect even where SO_PEERCRED is missing
+        old_umask = os.umask(0o177)
+        try:
+            sock.bind(path)
+        except OSError:
+            sock.close()
+            raise RuntimeError('Failed to create socket')
+        finally:
+            os.umask(old_umask)
+        self.path = path
+        self.inode = os.stat(path).st_ino
+        return sock
+
+    @staticmethod
+    def remove_stale(path: str) -> None:
+        # A file left by a crashed server refuses connections, a running server keeps its socket
+        try:
+            mode = os.lstat(path).st_mode
+        except FileNotFoundError:
+            return
+        except OSError:
+            raise RuntimeError('Failed to create socket')
+        if not stat.S_ISSOCK(mode):
+            raise RuntimeError(f'"{path}" exists and is not a socket')
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(path)
+        except ConnectionRefusedError:
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+            return
+        except OSError:
+            raise RuntimeError('Failed to create socket')
+        finally:
+            sock.close()
+        raise RuntimeError('Server is already running')
+
+    def accept_peer(self, conn: socket.socket) -> bool:
+        try:
+            peer = peer_uid(conn)
+        except OSError:
+            return False
+        if not peer:
+            return True
+        pid, uid = peer
+        if uid == os.getuid() or uid == 0:
+            return True
+        log.warn(f'Rejected client from uid {uid} (pid {pid})')
+        return False
+
+    def destroy(self) -> None:
+        super().destroy()
+        # Don't remove the socket of a newer server that replaced this one
+        try:
+            if self.path and os.stat(self.path).st_ino == self.inode:
+                os.unlink(self.path)
+        except OSError:
+            pass
+        self.path = ''
+
+
+class UnixClient(com_tcp.TCPClient):
+    def connect(self) -> socket.socket:
+        if not hasattr(socket, 'AF_UNIX'):
+            raise RuntimeError('Unix sockets are not supported')
+        path = socket_path(self.app.config)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(path)
+            # In a shared temp dir another user could have taken the path first, so commands only go to our server
+            peer = peer_uid(sock)
+            uid = peer[1] if peer else os.stat(path).st_uid
+        except Exception as _err:
+            sock.close()
+            raise RuntimeError(str(_err))
+        if not (uid == os.getuid() or uid == 0):
+            sock.close()
+            raise RuntimeError(f'Socket "{path}" belongs to uid {uid}')
+        return sock
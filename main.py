@@ -5,11 +5,25 @@ import time
 import datetime
 import json
 import random
+import threading
 import ctypes
+import array
+import itertools
+import collections
 import log
+import prefetch
+import track_cache
+import scanner
+import track_table
+import watcher
+import weights
+import shuffle
+import playlist
+import search
 import com_base
 import com_tcp
 import com_udp
+import com_unix
 import backend_base
 import backend_winmm
 import backend_sdl2
@@ -43,7 +57,8 @@ class App:
             self.write_json(
                 os.path.join(self.cwd, 'config.json'), self.read_json(os.path.join(self.cwd, 'default_config.json'))
             )
-        self.config = self.read_json(self.config_path)
+        self.config = self.read_json(os.path.join(self.cwd, 'default_config.json'))
+        self.config.update(self.read_json(self.config_path))
         log.enable_logging = self.config['allow_logging']
         try:
             if '--client-only' in self.argv or (self.config['need_server_arg'] and '--server-only' not in self.argv):
@@ -52,6 +67,8 @@ class App:
                 self.server: com_base.BaseServer = com_tcp.TCPServer(self)
             elif self.config['com_type'] == 'udp':
                 self.server: com_base.BaseServer = com_udp.UDPServer(self)
+            elif self.config['com_type'] == 'unix':
+                self.server: com_base.BaseServer = com_unix.UnixServer(self)
             else:
                 raise FileNotFoundError('Unknown communication type')
         except RuntimeError:
@@ -61,9 +78,15 @@ class App:
                 self.client: com_base.BaseClient = com_tcp.TCPClient(self)
             elif self.config['com_type'] == 'udp':
                 self.client: com_base.BaseClient = com_udp.UDPClient(self)
+            elif self.config['com_type'] == 'unix':
+                self.client: com_base.BaseClient = com_unix.UnixClient(self)
             else:
                 raise FileNotFoundError('Unknown communication type')
-            if self.argv and not (len(self.argv) <= 1 and self.argv[0] == '--client-only'):
+            if len(self.argv) == 1 and com_base.is_query(self.argv[0]):
+                self.print_query(self.argv[0])
+            elif len(self.argv) == 1 and self.argv[0] == 'subscribe':
+                self.print_events()
+            elif self.argv and not (len(self.argv) <= 1 and self.argv[0] == '--client-only'):
                 self.client.send(';'.join(self.argv))
                 self.exit_code = 0
                 # self.client.send('disconnect')
@@ -119,14 +142,67 @@ class App:
         self.speed = self.config['speed']
         if self.volume > 1.0:
             raise RuntimeError(f'Volume {self.volume} is bigger than 1.0')
-        self.full_list = []
-        self.temp_list = []
-        self.full_list_group = {}
+        # Playlists hold track IDs, paths are only built when a track is opened
+        self.tracks = track_table.TrackTable()
+        self.full_list = array.array('I')
+        self.temp_list = collections.deque()
+        self.full_list_group = scanner.TrackGroups()
+        # Track ID -> index in full_list, for the modes that keep a position in it
+        self.track_positions = array.array('i')
+        self.next_random_id = None
+        self.prefetch: prefetch.TrackPrefetch = None  # noqa
+        # Cancelled prefetches that may still be inside open_music, the backend can't quit before they are done
+        self.dropped_prefetches = []
+        # Set when a queue or library change dropped the prefetch, the track loop then opens the new next track
+        self.prefetch_stale = False
+        self.next_music: backend_base.BaseMusic = None  # noqa
+        self.fade_next = False
+        self.fading_music = []
+        if self.config['bad_track_cache']:
+            self.bad_tracks = track_cache.BadTrackCache(os.path.join(self.cwd, 'bad_tracks.json'), self.encoding)
+        else:
+            self.bad_tracks = None
+        if self.config['library_index']:
+            self.library_index = scanner.LibraryIndex(
+                os.path.join(self.cwd, 'library.idx'),
+                self.config['formats'],
+                self.config['group_by'],
+                self.config['search_index'] and self.config['search_tags']
+            )
+        else:
+            self.library_index = None
+        if self.config['allow_ffmpeg']:
+            self.durations = track_cache.DurationCache(
+                os.path.join(self.cwd, 'durations.json'), self.encoding, self.config['probe_workers']
+            )
+        else:
+            self.durations = None
+        if self.config['main_playlist_mode'] == 'weighted':
+            self.weights = weights.TrackWeights(
+                os.path.join(self.cwd, 'weights.dat'),
+                self.config['weighted_recent_window'],
+                self.config['weighted_recent_factor']
+            )
+        else:
+            self.weights = None
+        if self.config['main_playlist_mode'] == 'shuffle_bag':
+            self.shuffle_bag = shuffle.ShuffleBag(self.config['shuffle_window'])
+        else:
+            self.shuffle_bag = None
+        self.library_watcher: watcher.BaseWatcher = None  # noqa
+        self.removed_tracks = set()
+        self.missing_tracks = []
+        self.validated_tracks = []
+        self.search_index: search.SearchIndex = None  # noqa
+        self.rescan_thread: threading.Thread = None  # noqa
+        self.rescan_result = None
+        self.default_track_id = -1
         self.rescan()
         self.current_music: base_backend.BaseMusic = None # noqa
         self.running = True
-        self.default_track_id = -1
         self.next_is_switch_to_main = False
+        # Music that the last track event was about, the same file can be played twice in a row
+        self.event_music: backend_base.BaseMusic = None # noqa
         try:
             self.main_loop()
             self.should_kill = self.server.should_kill
@@ -140,41 +216,304 @@ class App:
             os.kill(os.getpid(), self.sig_kill)  # FIXME
     
     def rescan(self) -> None:
-        self.full_list.clear()
-        self.full_list_group.clear()
-        for arg in self.argv:
-            ext = arg.split('.')[-1].lower()
-            if ext not in self.config['formats']:
+        self.apply_rescan(self.scan_library(self.order_snapshot()))
+
+    def start_rescan(self) -> None:
+        # The scan runs on a worker, the main loop swaps the new lists in once it's done
+        if self.rescan_thread and self.rescan_thread.is_alive():
+            log.info('Rescan is already running')
+            return
+        self.rescan_thread = threading.Thread(
+            target=self.rescan_thread_func, args=(self.order_snapshot(), ), daemon=True
+        )
+        self.rescan_thread.start()
+
+    def order_snapshot(self) -> tuple:
+        # The old order is mapped on the worker, from a copy of the list the main loop can't change meanwhile
+        if self.config['main_playlist_mode'] == 'random_pick' and self.full_list:
+            return self.tracks, array.array('I', self.full_list)
+        return None
+
+    def rescan_thread_func(self, snapshot: tuple = None) -> None:
+        try:
+            self.rescan_result = self.scan_library(snapshot)
+        except Exception as _err:
+            # The old library keeps playing
+            log.warn('Rescan failed:', _err)
+        self.server.notify()
+
+    def poll_rescan(self) -> None:
+        result = self.rescan_result
+        if result:
+            self.rescan_result = None
+            self.apply_rescan(result)
+
+    def scan_library(self, snapshot: tuple = None) -> tuple:
+        # Only builds new structures, so it's safe to run next to the main loop
+        table = track_table.TrackTable()
+        full_list = array.array('I', table.add_paths(self.expand_paths(self.argv)))
+        listed = full_list
+        roots = []
+        scan_info = ''
+        groups = None
+        texts = ()
+        search_tags = self.config['search_index'] and self.config['search_tags']
+        if not full_list and self.config['music_path']:
+            roots = self.config['music_path']
+            roots = [roots] if isinstance(roots, str) else roots
+            playlists = [_root for _root in roots if playlist.is_playlist(_root)]
+            roots = [_root for _root in roots if not playlist.is_playlist(_root)]
+            if roots:
+                tracks, groups, texts, metrics = scanner.scan(
+                    roots,
+                    self.config['formats'],
+                    self.config['scan_threads'],
+                    self.config['scan_timeout'],
+                    self.config['scan_recursive'],
+                    self.library_index,
+                    self.config['group_by'],
+                    table,
+                    search_tags
+                )
+                full_list.extend(tracks)
+                if self.library_index:
+                    self.library_index.unload()
+                scan_info = f'({metrics["dirs"]} dirs scanned, {metrics["changed_dirs"]} changed, ' \
+                            f'in {round(metrics["time"], 3)}s)'
+            listed = array.array('I', table.add_paths(self.expand_paths(playlists)))
+            full_list.extend(listed)
+        full_list_group = scanner.group_tracks(table, full_list, groups, self.config['group_by'])
+        search_index = None
+        if self.config['search_index']:
+            search_index = search.SearchIndex(table)
+            if search_tags:
+                # Scanned tracks come first, tags of the ones from argv and playlists are read here
+                for i, track_id in enumerate(full_list):
+                    text = texts[i] if i < len(texts) else scanner.tag_text(table.path(track_id))
+                    search_index.set_tags(track_id, text)
+            search_index.build(full_list_group)
+        # Tracks from argv and playlists weren't found by listing dirs, so they are checked later
+        listed = array.array('I', listed)
+        kept = None
+        if self.config['main_playlist_mode'] == 'random_pick' and snapshot:
+            kept = (len(snapshot[1]), len(table))
+            full_list = self.keep_order(table, full_list, *snapshot)
+        elif self.config['main_playlist_mode'] == 'random_pick':
+            random.shuffle(full_list)
+        return table, full_list, full_list_group, search_index, roots, scan_info, listed, kept
+
+    def expand_paths(self, paths: list) -> any:
+        for fp in paths:
+            if playlist.is_playlist(fp):
+                yield from playlist.read_playlist(fp, self.config['formats'], self.encoding)
+            elif fp.split('.')[-1].lower() in self.config['formats']:
+                yield fp
+
+    def on_missing_tracks(self, table: track_table.TrackTable, missing: list) -> None:
+        self.missing_tracks.append((table, missing, False))
+        self.server.notify()
+
+    def on_missing_temp_tracks(self, table: track_table.TrackTable, missing: list) -> None:
+        self.missing_tracks.append((table, missing, True))
+        self.server.notify()
+
+    def on_validated_tracks(self, bad: list) -> None:
+        self.validated_tracks.append(bad)
+        self.server.notify()
+
+    def apply_validated_tracks(self) -> None:
+        while self.validated_tracks:
+            for fp, key in self.validated_tracks.pop(0):
+                self.bad_tracks.add(fp, key)
+            self.bad_tracks.save()
+
+    def apply_missing_tracks(self) -> None:
+        while self.missing_tracks:
+            table, missing, is_temp = self.missing_tracks.pop(0)
+            if table is not self.tracks or not missing:  # The table was replaced by a rescan meanwhile
+                continue
+            if is_temp:
+                # Temp playlist tracks aren't in the library, so they are just dropped from the queue
+                missing = set(missing)
+                self.temp_list = collections.deque(_id for _id in self.temp_list if _id not in missing)
+                if self.prefetch and self.tracks.find(self.prefetch.fp) in missing:
+                    self.drop_prefetch()
+                log.warn('Skipping', len(missing), 'missing temp playlist tracks')
                 continue
-            self.full_list.append(arg)
-        if not self.full_list and self.config['music_path']:
-            for fn in os.listdir(self.config['music_path']):
-                ext = fn.split('.')[-1].lower()
-                if ext not in self.config['formats']:
+            # Same tombstones as for the tracks removed from the library
+            self.removed_tracks.update(missing)
+            if self.next_random_id in self.removed_tracks:
+                self.next_random_id = None
+            if self.prefetch and self.tracks.find(self.prefetch.fp) in self.removed_tracks:
+                self.drop_prefetch()
+            log.warn('Skipping', len(missing), 'missing playlist tracks')
+            if len(self.removed_tracks) > max(len(self.full_list) // 8, 64):
+                self.compact_library()
+
+    def apply_rescan(self, result: tuple) -> None:
+        table, full_list, full_list_group, search_index, roots, scan_info, listed, kept = result
+        self.drop_prefetch()
+        self.next_random_id = None
+        position_fp = None
+        if 0 <= self.default_track_id < len(self.full_list):
+            position_fp = self.tracks.path(self.full_list[self.default_track_id])
+        if kept:
+            # Only tracks the watcher appended after the snapshot are left, the scan may have missed the newest ones
+            snapshot_len, scanned_len = kept
+            appended = [_id for _id in self.full_list[snapshot_len:] if _id not in self.removed_tracks]
+            added = set()
+            for track_id in table.add_paths(self.tracks.paths(appended)):
+                if track_id >= scanned_len and track_id not in added:
+                    added.add(track_id)
+                    full_list.append(track_id)
+        # Temp list IDs point into the old table
+        self.temp_list = collections.deque(table.add_paths(self.tracks.paths(self.temp_list)))
+        self.tracks = table
+        self.full_list = full_list
+        self.index_positions()
+        # Keep playing from the same track if it's still there
+        position = self.track_position(table.find(position_fp)) if position_fp else -1
+        self.default_track_id = position if position >= 0 else min(self.default_track_id, len(full_list) - 1)
+        self.full_list_group = full_list_group
+        self.search_index = search_index
+        self.removed_tracks.clear()
+        if self.library_watcher:
+            self.library_watcher.destroy()
+            self.library_watcher = None
+        if roots and self.config['watch_library']:
+            self.library_watcher = watcher.create_watcher(
+                roots,
+                self.config['formats'],
+                # The watcher reads paths on its own thread, full_list can change meanwhile
+                self.tracks.paths(array.array('I', self.full_list)),
+                self.server.notify,
+                self.config['scan_recursive'],
+                self.config['watch_interval']
+            )
+        if self.weights:
+            self.weights.rebuild(self.full_list, self.tracks)
+        if self.shuffle_bag:
+            self.shuffle_bag.forget_recent()
+            self.shuffle_bag.reset(len(self.full_list))
+        log.info('Music scan results:', len(self.full_list), 'tracks in the full list', scan_info)
+        if listed:
+            playlist.find_missing(self.tracks, listed, self.on_missing_tracks)
+
+    @staticmethod
+    def keep_order(table: track_table.TrackTable, full_list: array.array, old_table: track_table.TrackTable,
+                   old_list: array.array) -> array.array:
+        # The shuffled order goes on after a rescan, tracks that are new get shuffled in after the old ones
+        size = len(table)
+        pending = bytearray(size)
+        for track_id in full_list:
+            pending[track_id] = 1
+        new_ids = table.map_ids(old_table)
+        result = array.array('I')
+        for old_id in old_list:
+            track_id = new_ids[old_id]
+            if track_id >= 0 and pending[track_id]:
+                pending[track_id] = 0
+                result.append(track_id)
+        new_tracks = [_id for _id in full_list if pending[_id]]
+        random.shuffle(new_tracks)
+        result.extend(new_tracks)
+        return result
+
+    def apply_library_changes(self) -> None:
+        if not self.library_watcher:
+            return
+        for action, fp in self.library_watcher.pop_deltas():
+            track_id = self.tracks.find(fp)
+            if action == 'remove':
+                if track_id < 0:
                     continue
-                self.full_list.append(os.path.join(self.config['music_path'], fn))
-        for track_fp in self.full_list:
-            music_group = os.path.basename(track_fp).split(' - ')[0].strip()
-            if music_group in self.full_list_group:
-                self.full_list_group[music_group].append(track_fp)
+                # Removed tracks stay in the lists as tombstones, so positions and the shuffle order are kept
+                self.removed_tracks.add(track_id)
+                if track_id == self.next_random_id:
+                    self.next_random_id = None
+                if self.prefetch and self.prefetch.fp == fp:
+                    self.drop_prefetch()
+                log.info('Track removed:', fp)
+            elif track_id in self.removed_tracks:
+                self.removed_tracks.remove(track_id)
             else:
-                self.full_list_group[music_group] = [track_fp]
-        if self.config['main_playlist_mode'] == 'random_pick':
-            random.shuffle(self.full_list)
-        log.info('Music scan results:', len(self.full_list), 'tracks in the full list')
+                if track_id < 0:
+                    track_id = self.tracks.add(fp)
+                self.full_list.append(track_id)
+                self.set_position(track_id, len(self.full_list) - 1)
+                music_group, text = scanner.track_info(
+                    fp, self.config['group_by'], self.search_index and self.config['search_tags']
+                )
+                self.full_list_group.add(music_group, track_id)
+                if self.search_index:
+                    self.search_index.add(track_id, music_group, text)
+                if self.weights:
+                    self.weights.append(fp)
+                if self.shuffle_bag:
+                    self.shuffle_bag.grow()
+                log.info('Track added:', fp)
+        if len(self.removed_tracks) > max(len(self.full_list) // 8, 64):
+            self.compact_library()
+
+    def compact_library(self) -> None:
+        if self.rescan_result or (self.rescan_thread and self.rescan_thread.is_alive()):
+            # The rescan drops the tombstones anyway, and it counts on full_list only growing until then
+            return
+        # Amortized over at least len / 8 removals, so still O(1) per change
+        removed = self.removed_tracks
+        self.default_track_id -= sum(1 for _id in self.full_list[:self.default_track_id + 1] if _id in removed)
+        self.full_list[:] = array.array('I', (_id for _id in self.full_list if _id not in removed))
+        for music_group, group_tracks in tuple(self.full_list_group.items()):
+            group_tracks[:] = array.array('I', (_id for _id in group_tracks if _id not in removed))
+            if not group_tracks:
+                self.full_list_group.remove(music_group)
+        self.temp_list = collections.deque(_id for _id in self.temp_list if _id not in removed)
+        self.index_positions()
+        if self.search_index:
+            self.search_index.remove(removed)
+        removed.clear()
+        if self.weights:
+            self.weights.rebuild(self.full_list, self.tracks)
+        if self.shuffle_bag:
+            self.shuffle_bag.reset(len(self.full_list))
 
     def track_loop(self) -> None:
-        if self.config['print_json'] and self.config['print_json_time']:
+        print_time = self.config['print_json'] and self.config['print_json_time']
+        if print_time:
             last_format = ''
-            len_format = self.format_time(self.current_music.length)
-        while self.running and self.current_music and self.current_music.is_playing():
+        while self.running and self.current_music and not self.current_music.is_finished():
             self.server.update()
             self.poll_commands()
+            if not self.running:  # Don't wait for the track to end after exit
+                break
+            self.poll_rescan()
+            self.apply_library_changes()
+            self.apply_missing_tracks()
+            self.apply_validated_tracks()
+            if self.prefetch_stale:
+                self.start_prefetch()
             self.bk.update()
-            if self.config['print_json'] and self.config['print_json_time']:
-                cur_format = self.format_time(self.current_music.get_pos())
+            self.reap_fading_music()
+            self.update_state()
+            # Backends with a finished event wake us up themselves, the rest have to be polled
+            timeout = None if self.current_music.has_finished_event else self.config['loop_interval']
+            if self.config['crossfade_ms'] > 0 and not self.fade_next and self.current_music.length\
+                    and not self.current_music.paused:
+                fade_left = self.current_music.length - self.current_music.get_pos() - \
+                    self.config['crossfade_ms'] / 1000
+                if fade_left <= 0:
+                    self.fade_out_current()
+                    if self.next_music:
+                        break
+                else:
+                    timeout = min(timeout or fade_left, fade_left)
+            if print_time:
+                cur_pos = self.current_music.get_pos()
+                cur_format = self.format_time(cur_pos)
                 if not cur_format == last_format:  # noqa
                     last_format = cur_format
+                    # The length may arrive after the track has started
+                    len_format = self.format_time(self.current_music.length)
                     output = {
                         'text': '[' + cur_format + '/' + len_format + '] ' +  # noqa
                                 self.current_music.fn_no_ext,
@@ -183,54 +522,126 @@ class App:
                     }
                     sys.stdout.write(json.dumps(output) + '\n')
                     sys.stdout.flush()
-    
-    @staticmethod
-    def error_opening_mus(fp: str, err: RuntimeError) -> None:
+                # format_time rounds, so the text changes when the position crosses a half second
+                timeout = min(timeout or 1.0, 1.0 - (cur_pos + 0.5) % 1.0)
+            if self.server.has_subscribers() and not self.current_music.paused:
+                # Subscribers get a position event every second
+                timeout = min(timeout or 1.0, 1.0 - self.current_music.get_pos() % 1.0 + 0.001)
+            self.server.wait(timeout)
+
+    def error_opening_mus(self, fp: str, err: RuntimeError) -> None:
         log.warn(f'Failed to open music "{fp}": {err}')
+        if self.bad_tracks:
+            self.bad_tracks.add(fp)
 
-    def next_track(self) -> any:
+    def next_track_id(self) -> int:
         # TODO: maybe allow to change mode in real time?
         if self.temp_list:
-            fp = self.temp_list.pop(0)  # Only default and random pick modes currently
+            track_id = self.temp_list.popleft()  # Only default and random pick modes currently
             if not self.temp_list:
                 self.next_is_switch_to_main = True
-            try:
-                return self.bk.open_music(fp)
-            except RuntimeError as _err:
-                self.error_opening_mus(fp, _err)
-                return None
+            return track_id
         if self.next_is_switch_to_main:
             self.next_is_switch_to_main = False
             log.info('Switched back to main list')
+        if not self.full_list:
+            return None
         if self.config['main_playlist_mode'] in ('default', 'random_pick'):
             self.default_track_id += 1
             if self.default_track_id >= len(self.full_list):
                 if self.config['main_playlist_mode'] == 'random_pick':
                     random.shuffle(self.full_list)
+                    self.index_positions()
                 self.default_track_id = 0
-            fp = self.full_list[self.default_track_id]
-            try:
-                return self.bk.open_music(fp)
-            except RuntimeError as _err:
-                self.error_opening_mus(fp, _err)
-                return None
-        elif self.config['main_playlist_mode'] == 'random_full':
-            fp = random.choice(self.full_list)
-            try:
-                return self.bk.open_music(fp)
-            except RuntimeError as _err:
-                self.error_opening_mus(fp, _err)
-                return None
-        elif self.config['main_playlist_mode'] == 'random_group':
-            group_tracks = random.choice(tuple(self.full_list_group.values()))
-            fp = random.choice(group_tracks)
-            try:
-                return self.bk.open_music(fp)
-            except RuntimeError as _err:
-                self.error_opening_mus(fp, _err)
-                return None
+            return self.full_list[self.default_track_id]
+        elif self.config['main_playlist_mode'] in ('random_full', 'random_group', 'weighted', 'shuffle_bag'):
+            track_id = self.random_track_id() if self.next_random_id is None else self.next_random_id
+            self.next_random_id = None
+            return track_id
+        return None
+
+    def peek_track_id(self) -> int:
+        # Same as next_track_id, but doesn't advance the playlists
+        if self.temp_list:
+            return self.temp_list[0]
+        if not self.full_list:
+            return None
+        if self.config['main_playlist_mode'] in ('default', 'random_pick'):
+            if self.default_track_id + 1 < len(self.full_list):
+                return self.full_list[self.default_track_id + 1]
+            if self.config['main_playlist_mode'] == 'default':
+                return self.full_list[0]
+            return None  # The list will be shuffled again
+        elif self.config['main_playlist_mode'] in ('random_full', 'random_group', 'weighted', 'shuffle_bag'):
+            if self.next_random_id is None:
+                self.next_random_id = self.random_track_id()
+            return self.next_random_id
         return None
 
+    def random_track_id(self) -> int:
+        if self.config['main_playlist_mode'] == 'random_group':
+            return self.full_list_group.random_track()
+        if self.config['main_playlist_mode'] == 'weighted':
+            i = self.weights.pick()
+            if i < 0:
+                return None
+            if self.full_list[i] in self.removed_tracks:
+                self.weights.drop(i)
+            return self.full_list[i]
+        if self.config['main_playlist_mode'] == 'shuffle_bag':
+            return self.full_list[self.shuffle_bag.pick(self.full_list)]
+        return random.choice(self.full_list)
+
+    def next_track(self) -> any:
+        self.poll_rescan()
+        self.apply_library_changes()
+        self.apply_missing_tracks()
+        self.apply_validated_tracks()
+        track_id = self.next_track_id()
+        if track_id is None or track_id in self.removed_tracks:
+            return None
+        fp = self.tracks.path(track_id)
+        if self.bad_tracks and self.bad_tracks.is_bad(fp):
+            return None
+        try:
+            if self.prefetch and self.prefetch.fp == fp:
+                prefetch_track = self.prefetch
+                self.prefetch = None
+                return prefetch_track.take()
+            self.drop_prefetch()
+            return self.bk.open_music(fp)
+        except RuntimeError as _err:
+            self.error_opening_mus(fp, _err)
+            return None
+
+    def start_prefetch(self) -> None:
+        self.prefetch_stale = False
+        if not self.config['preload_next'] or not self.bk.thread_safe:
+            return
+        track_id = self.peek_track_id()
+        if track_id is None or track_id in self.removed_tracks:
+            self.drop_prefetch()
+            self.prefetch_stale = False
+            return
+        fp = self.tracks.path(track_id)
+        if self.prefetch and self.prefetch.fp == fp:
+            return
+        self.drop_prefetch()
+        self.prefetch_stale = False
+        if not (self.bad_tracks and self.bad_tracks.is_bad(fp)):
+            self.prefetch = prefetch.TrackPrefetch(self.bk, fp)
+
+    def drop_prefetch(self, wait: bool = False) -> None:
+        if self.prefetch:
+            self.prefetch.cancel()
+            self.dropped_prefetches.append(self.prefetch)
+            self.prefetch = None
+        self.prefetch_stale = True
+        if wait:
+            for prefetch_track in self.dropped_prefetches:
+                prefetch_track.done.wait()
+        self.dropped_prefetches = [_p for _p in self.dropped_prefetches if not _p.done.is_set()]
+
     @staticmethod
     def format_time(need_time: float) -> str:
         round_time = round(need_time)
@@ -240,9 +651,25 @@ class App:
     def main_loop(self) -> None:
         pause_first = self.config['pause_first']
         while self.running:
-            mus: backend_base.BaseMusic = self.next_track()
-            while not mus:
+            mus: backend_base.BaseMusic = self.next_music or self.next_track()
+            self.next_music = None
+            fail_count = 0
+            backoff = 0.5
+            while not mus and self.running:
+                fail_count += 1
+                if fail_count > len(self.full_list):
+                    # Every candidate failed, so don't keep hammering the disk and the decoder
+                    log.warn(f'Failed to open any track, retrying in {backoff} seconds')
+                    if self.bad_tracks:
+                        self.bad_tracks.save()
+                    self.server.wait(backoff)
+                    self.poll_commands()
+                    self.update_state()
+                    backoff = min(backoff * 2, 60.0)
+                    fail_count = 0
                 mus = self.next_track()
+            if not mus:
+                break
             self.play_new_music(mus)
             if pause_first:
                 mus.set_paused(True)
@@ -272,28 +699,53 @@ class App:
                 f.close()
             if self.someblocks_pid:
                 os.kill(self.someblocks_pid, 34 + 10)
+            self.start_prefetch()
             self.track_loop()
 
     def play_new_music(self, mus: backend_base.BaseMusic) -> None:
         if self.current_music:
-            self.current_music.stop()
-            self.current_music.destroy()
-        mus.play()
+            if self.fade_next and self.bk.can_overlap and not self.current_music.is_finished():
+                self.fading_music.append(self.current_music)
+            else:
+                self.current_music.stop()
+                self.current_music.destroy()
+        if self.fade_next:
+            mus.fade_in(self.config['crossfade_ms'])
+            self.fade_next = False
+        else:
+            mus.play()
         mus.set_volume(self.volume)
         mus.set_speed(self.speed)
         self.current_music = mus
 
+    def fade_out_current(self) -> None:
+        # Backends that can play two tracks at once get the next one started right away,
+        # the rest fade out first and fade the next track in once the current one has stopped
+        self.fade_next = True
+        if self.bk.can_overlap:
+            self.next_music = self.next_track()
+        self.current_music.fade_out(self.config['crossfade_ms'])
+
+    def reap_fading_music(self) -> None:
+        for mus in tuple(self.fading_music):
+            if mus.is_finished():
+                self.fading_music.remove(mus)
+                mus.destroy()
+
     def poll_commands(self) -> None:
+        self.poll_requests()
         temp_mus = []
-        while self.server.commands:
-            cmds = self.server.commands.pop(0)
+        for cmds in self.server.commands.pop_all():
             for _cmd in cmds.split(';'):
                 cmd = _cmd.strip()
-                if os.path.isfile(cmd) and cmd.split('.')[-1].lower() in self.config['formats']:
+                if os.path.isfile(cmd) and (cmd.split('.')[-1].lower() in self.config['formats'] or
+                                            playlist.is_playlist(cmd)):
                     temp_mus.append(cmd)
                     continue
                 if cmd == 'next':
                     if self.current_music:
+                        if self.weights and self.current_music.get_pos() < self.config['skip_threshold']:
+                            self.weights.skip(self.current_music.fp)
                         self.current_music.stop()
                 elif cmd in ('toggle_pause', 'pause', 'resume'):
                     if self.current_music:
@@ -307,6 +759,7 @@ class App:
                     pass
                 elif cmd == 'clear_temp':
                     self.temp_list.clear()
+                    self.drop_prefetch()
                     if self.current_music:
                         self.current_music.stop()
                     # log.info('Temp music list cleared')
@@ -372,24 +825,136 @@ class App:
                     if self.current_music:
                         self.current_music.set_speed(self.speed)
                     log.info('New Speed:', self.speed)
+                elif cmd.startswith('rate '):
+                    if not self.current_music or not self.weights:
+                        continue
+                    try:
+                        rating = int(cmd.split(' ')[-1])
+                    except (ValueError, IndexError) as _err:
+                        log.warn(f'Could not convert rating value:', _err)
+                        continue
+                    self.weights.rate(self.current_music.fp, max(min(rating, 5), 0))
+                    log.info('New Rating:', max(min(rating, 5), 0))
+                elif cmd.startswith('find '):
+                    found = self.search_tracks(cmd[5:])
+                    log.info('Found', len(found), 'tracks')
+                    for track_id in found[:self.config['search_limit']]:
+                        log.info(self.tracks.path(track_id))
+                elif cmd.startswith('enqueue ') or cmd.startswith('enqueue_next '):
+                    found = self.search_tracks(cmd.split(' ', 1)[1])
+                    if not found:
+                        log.info('Nothing to enqueue')
+                        continue
+                    if cmd.startswith('enqueue_next '):
+                        self.drop_prefetch()
+                        self.temp_list.extendleft(reversed(found))
+                    else:
+                        if not self.temp_list:
+                            self.drop_prefetch()
+                        self.temp_list.extend(found)
+                    log.info('Enqueued', len(found), 'tracks')
+                elif cmd.startswith('dequeue '):
+                    try:
+                        pos = int(cmd.split(' ')[-1]) - 1
+                    except ValueError as _err:
+                        log.warn('Could not convert temp playlist position:', _err)
+                        continue
+                    if not 0 <= pos < len(self.temp_list):
+                        log.warn('No such temp playlist position:', pos + 1)
+                        continue
+                    # Deque removes in O(1) at the ends, the middle costs the distance to the nearest end
+                    track_id = self.temp_list[pos]
+                    del self.temp_list[pos]
+                    if pos == 0:
+                        self.drop_prefetch()
+                    log.info('Dequeued', self.tracks.path(track_id))
+                elif cmd.startswith('move '):
+                    try:
+                        pos_from, pos_to = (int(_pos) - 1 for _pos in cmd.split(' ')[1:3])
+                    except ValueError as _err:
+                        log.warn('Could not convert temp playlist position:', _err)
+                        continue
+                    if not 0 <= pos_from < len(self.temp_list) or pos_to < 0:
+                        log.warn('No such temp playlist position:', pos_from + 1)
+                        continue
+                    track_id = self.temp_list[pos_from]
+                    del self.temp_list[pos_from]
+                    self.temp_list.insert(pos_to, track_id)
+                    if pos_from == 0 or pos_to == 0:
+                        self.drop_prefetch()
+                    log.info('Moved', self.tracks.path(track_id))
                 elif cmd == 'rescan':
-                    self.rescan()
+                    self.start_rescan()
+                elif cmd == 'validate':
+                    if self.bad_tracks:
+                        log.info('Validating', len(self.full_list), 'tracks')
+                        self.bad_tracks.validate(
+                            self.tracks.paths(self.full_list), self.on_validated_tracks, self.config['validate_workers']
+                        )
+                    else:
+                        log.warn('Bad track cache is disabled')
                 elif cmd == 'exit' or cmd == 'quit':
                     self.running = False
                 else:
                     log.warn('Unknown Command', cmd)
         if temp_mus:
-            self.temp_list = temp_mus
+            self.drop_prefetch()
+            self.temp_list = collections.deque(self.tracks.add_paths(self.expand_paths(temp_mus)))
+            if not self.temp_list:
+                log.warn('No tracks found for the temp playlist')
+                return
+            if any(playlist.is_playlist(fp) for fp in temp_mus):
+                playlist.find_missing(self.tracks, array.array('I', self.temp_list), self.on_missing_temp_tracks)
             self.temp_list_prepare()
             log.info('Playing Temp Playlist')
             if self.current_music:
                 self.current_music.stop()
 
+    def search_tracks(self, query: str) -> list:
+        if not self.search_index:
+            log.warn('Search index is disabled')
+            return []
+        return [_id for _id in self.search_index.find(query, self.full_list_group) if _id not in self.removed_tracks]
+
+    def poll_requests(self) -> None:
+        # Queries the I/O threads can't answer from the state snapshot
+        for request_id, query, reply in self.server.pop_requests():
+            name, _, arg = query.partition(' ')
+            if name == 'find' and not self.search_index:
+                reply(self.server.response(request_id, error='Search index is disabled'))
+            elif name == 'find':
+                found = self.search_tracks(arg)
+                result = {'count': len(found), 'tracks': list(self.tracks.paths(found[:self.config['search_limit']]))}
+                reply(self.server.response(request_id, result))
+            else:
+                reply(self.server.response(request_id, error=f'Unknown query "{query}"'))
+
     def temp_list_prepare(self) -> None:
-        if self.config['main_playlist_mode'] == 'default' and self.temp_list[-1] in self.full_list:
-            self.default_track_id = self.full_list.index(self.temp_list[-1]) + 1
+        if self.config['main_playlist_mode'] == 'default' and self.track_position(self.temp_list[-1]) >= 0:
+            self.default_track_id = self.track_position(self.temp_list[-1]) + 1
         if self.config['temp_playlist_mode'] == 'random_pick':  # Trick
-            random.shuffle(self.temp_list)
+            # Indexing a deque is O(n) in the middle, so it's not shuffled in place
+            self.temp_list = collections.deque(random.sample(self.temp_list, len(self.temp_list)))
+
+    def index_positions(self) -> None:
+        if self.config['main_playlist_mode'] not in ('default', 'random_pick'):
+            return
+        self.track_positions = array.array('i', [-1]) * len(self.tracks)
+        for i, track_id in enumerate(self.full_list):
+            self.track_positions[track_id] = i
+
+    def track_position(self, track_id: int) -> int:
+        if 0 <= track_id < len(self.track_positions):
+            return self.track_positions[track_id]
+        return -1
+
+    def set_position(self, track_id: int, position: int) -> None:
+        if self.config['main_playlist_mode'] not in ('default', 'random_pick'):
+            return
+        if track_id >= len(self.track_positions):
+            # Tracks from the temp playlists grow the table too
+            self.track_positions.extend(array.array('i', [-1]) * (track_id + 1 - len(self.track_positions)))
+        self.track_positions[track_id] = position
 
     def display_info(self) -> None:
         log.info('Welcome to the Pixelsuft MUST!')
@@ -399,6 +964,23 @@ class App:
         log.info('Current Device:', self.bk.get_current_audio_device_name())
 
     def cleanup(self) -> None:
+        if self.library_watcher:
+            self.library_watcher.destroy()
+            self.library_watcher = None
+        self.drop_prefetch(wait=True)
+        if self.bad_tracks:
+            self.bad_tracks.save()
+        if self.weights:
+            self.weights.save()
+        if self.durations:
+            self.durations.destroy()
+        if self.next_music:
+            self.next_music.destroy()
+            self.next_music = None
+        for mus in self.fading_music:
+            mus.stop()
+            mus.destroy()
+        self.fading_music.clear()
         if self.server:
             self.server.destroy()
             # self.server = None
@@ -410,6 +992,10 @@ class App:
     def client_prompt(self) -> None:
         msg = 'i_want_to_live_please_do\'nt_die'
         while msg is not None:
+            if com_base.is_query(msg):
+                self.print_query(msg)
+                msg = input('>>> ')
+                continue
             try:
                 self.client.send(msg)
                 if msg == 'disconnect' or msg == 'exit' or msg == 'quit':
@@ -419,6 +1005,87 @@ class App:
                 return
             msg = input('>>> ')
 
+    def print_query(self, query: str) -> None:
+        try:
+            result = self.client.request(query)
+        except RuntimeError as _err:
+            log.warn('Query failed:', _err)
+            return
+        sys.stdout.write(json.dumps(result) + '\n')
+        sys.stdout.flush()
+
+    def print_events(self) -> None:
+        # One JSON object per line until the server goes away
+        try:
+            for event in self.client.subscribe():
+                sys.stdout.write(json.dumps(event) + '\n')
+                sys.stdout.flush()
+        except RuntimeError as _err:
+            log.warn('Subscription failed:', _err)
+        except KeyboardInterrupt:
+            pass
+
+    def update_state(self) -> None:
+        # Snapshot for the queries, the I/O threads read it instead of calling into the backend
+        mus = self.current_music
+        old_state = self.server.state
+        self.server.set_state({
+            'status': {
+                'track': mus and mus.fp,
+                'title': mus and mus.fn_no_ext,
+                'paused': bool(mus and mus.paused),
+                'volume': self.volume,
+                'speed': self.speed,
+                'mode': self.config['main_playlist_mode'],
+                'temp_playlist': bool(self.temp_list)
+            },
+            'position': {
+                'pos': mus.get_pos() if mus else 0.0,
+                'length': mus.length if mus else 0.0,
+                'paused': bool(mus and mus.paused),
+                'playing': bool(mus and not mus.is_finished()),
+                'time': time.monotonic()
+            },
+            'queue': {
+                'count': len(self.temp_list),
+                'tracks': list(self.tracks.paths(itertools.islice(self.temp_list, self.config['queue_limit'])))
+            },
+            'library_stats': {
+                'tracks': len(self.full_list) - len(self.removed_tracks),
+                'removed_tracks': len(self.removed_tracks),
+                'groups': len(self.full_list_group),
+                'table_size': len(self.tracks),
+                'rescanning': bool(self.rescan_thread and self.rescan_thread.is_alive()),
+                'watching': bool(self.library_watcher)
+            }
+        })
+        new_track = mus is not self.event_music
+        self.event_music = mus
+        if self.server.has_subscribers():
+            self.publish_events(old_state, self.server.state, new_track)
+
+    def publish_events(self, old_state: dict, state: dict, new_track: bool) -> None:
+        old_status = old_state.get('status') or {}
+        status = state['status']
+        if new_track and status['track']:
+            self.server.publish({
+                'event': 'track',
+                'track': status['track'],
+                'title': status['title'],
+                'length': state['position']['length']
+            })
+        if not status['paused'] == old_status.get('paused'):
+            self.server.publish({'event': 'pause', 'paused': status['paused']})
+        if not status['volume'] == old_status.get('volume'):
+            self.server.publish({'event': 'volume', 'volume': status['volume']})
+        old_pos = (old_state.get('position') or {}).get('pos', -1.0)
+        if status['track'] and (new_track or not int(state['position']['pos']) == int(old_pos)):
+            self.server.publish({
+                'event': 'position',
+                'pos': state['position']['pos'],
+                'length': state['position']['length']
+            })
+
     def read_json(self, fp: str) -> dict:
         f = open(fp, 'r', encoding=self.encoding)
         content = f.read()
@@ -0,0 +1,63 @@
+import os
+import sys
+import threading
+import urllib.parse
+import log
+
+
+FORMATS = ('m3u', 'm3u8', 'pls')
+
+
+def is_playlist(fp: str) -> bool:
+    return fp.split('.')[-1].lower() in FORMATS
+
+
+def entry_path(entry: str, base_dir: str) -> str:
+    if '://' in entry:
+        if not entry.lower().startswith('file://'):
+            return ''  # Streams aren't supported
+        entry = urllib.parse.unquote(entry[7:])
+        if sys.platform == 'win32' and entry[:1] == '/' and entry[2:3] == ':':
+            entry = entry[1:]
+    elif os.sep == '/':
+        # Playlists made on Windows use backslashes even for relative paths
+        entry = entry.replace('\\', '/')
+    return os.path.normpath(os.path.join(base_dir, entry))
+
+
+def read_playlist(fp: str, formats: list, encoding: str = 'utf-8') -> any:
+    # Yields track paths one by one, so even huge playlists are never loaded as a whole
+    is_pls = fp.split('.')[-1].lower() == 'pls'
+    if fp.split('.')[-1].lower() == 'm3u8':
+        encoding = 'utf-8'
+    base_dir = os.path.dirname(fp)
+    try:
+        f = open(fp, 'r', encoding=encoding, errors='surrogateescape')
+    except OSError as _err:
+        log.warn(f'Failed to open playlist "{fp}": {_err}')
+        return
+    with f:
+        for line in f:
+            entry = line.strip().lstrip('\ufeff')
+            if is_pls:
+                key, _, entry = entry.partition('=')
+                if not key.lower().startswith('file'):
+                    continue
+                entry = entry.strip()
+            elif entry.startswith('#'):
+                continue
+            if not entry or entry.split('.')[-1].lower() not in formats:
+                continue
+            entry = entry_path(entry, base_dir)
+            if entry:
+                yield entry
+
+
+def find_missing(table: any, track_ids: any, on_done: any) -> None:
+    # Existence checks are slow on network drives, so they are done in the background
+    threading.Thread(target=find_missing_thread, args=(table, track_ids, on_done), daemon=True).start()
+
+
+def find_missing_thread(table: any, track_ids: any, on_done: any) -> None:
+    missing = [_id for _id in track_ids if not os.path.isfile(table.path(_id))]
+    on_done(table, missing)
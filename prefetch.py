@@ -0,0 +1,46 @@
+import threading
+import backend_base
+
+
+class TrackPrefetch:
+    def __init__(self, bk: backend_base.BaseBackend, fp: str) -> None:
+        self.bk = bk
+        self.fp = fp
+        self.mus: backend_base.BaseMusic = None  # noqa
+        self.err: RuntimeError = None  # noqa
+        self.cancelled = False
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+        threading.Thread(target=self.open_thread, daemon=True).start()
+
+    def open_thread(self) -> None:
+        try:
+            mus = self.bk.open_music(self.fp)
+        except RuntimeError as _err:
+            mus = None
+            self.err = _err
+        with self.lock:
+            if self.cancelled:
+                # Nobody is going to take it anymore
+                if mus:
+                    mus.destroy()
+                mus = None
+            self.mus = mus
+        self.done.set()
+
+    def take(self) -> backend_base.BaseMusic:
+        self.done.wait()
+        if self.err:
+            raise self.err
+        mus = self.mus
+        self.mus = None
+        return mus
+
+    def cancel(self, wait: bool = False) -> None:
+        with self.lock:
+            self.cancelled = True
+            if self.mus:
+                self.mus.destroy()
+                self.mus = None
+        if wait:
+            self.done.wait()
@@ -0,0 +1,335 @@
+import os
+import time
+import queue
+import array
+import marshal
+import random
+import threading
+import log
+import tags
+import track_table
+
+
+def group_key(fp: str, group_by: str = 'filename', track_tags: dict = None) -> str:
+    if group_by in ('artist', 'album'):
+        track_tags = track_tags or tags.read_tags(fp)
+        if group_by == 'album' and track_tags['album']:
+            return track_tags['artist'] + ' - ' + track_tags['album']
+        if track_tags['artist']:
+            return track_tags['artist']
+    # Files without tags fall back to the "Artist - Title" file name
+    return os.path.basename(fp).split(' - ')[0].strip()
+
+
+def tag_text(fp: str, track_tags: dict = None) -> str:
+    track_tags = track_tags or tags.read_tags(fp)
+    return ' '.join(_tag for _tag in (track_tags['artist'], track_tags['album'], track_tags['title']) if _tag)
+
+
+def track_info(fp: str, group_by: str = 'filename', search_tags: bool = False) -> tuple:
+    # Group key and searchable tag text from one read of the header
+    if not search_tags:
+        return group_key(fp, group_by), ''
+    track_tags = tags.read_tags(fp)
+    return group_key(fp, group_by, track_tags), tag_text(fp, track_tags)
+
+
+class TrackGroups:
+    def __init__(self) -> None:
+        # The track lists are kept in an array, so picking a random group is O(1) without copying anything
+        self.keys = []
+        self.tracks = []
+        self.index = {}
+
+    def __len__(self) -> int:
+        return len(self.tracks)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.index
+
+    def __getitem__(self, key: str) -> array.array:
+        return self.tracks[self.index[key]]
+
+    def items(self) -> zip:
+        return zip(self.keys, self.tracks)
+
+    def clear(self) -> None:
+        self.keys.clear()
+        self.tracks.clear()
+        self.index.clear()
+
+    def add(self, key: str, track_id: int) -> None:
+        i = self.index.get(key)
+        if i is None:
+            self.index[key] = len(self.keys)
+            self.keys.append(key)
+            self.tracks.append(array.array('I', (track_id, )))
+        else:
+            self.tracks[i].append(track_id)
+
+    def remove(self, key: str) -> None:
+        # Move the last group into the hole, so removal is O(1) too
+        i = self.index.pop(key)
+        last_key = self.keys.pop()
+        last_tracks = self.tracks.pop()
+        if i < len(self.keys):
+            self.keys[i] = last_key
+            self.tracks[i] = last_tracks
+            self.index[last_key] = i
+
+    def random_track(self) -> int:
+        if not self.tracks:
+            return None
+        return random.choice(random.choice(self.tracks))
+
+
+def group_tracks(table: track_table.TrackTable, tracks: array.array, groups: list = None,
+                 group_by: str = 'filename') -> TrackGroups:
+    # Known groups may cover only the start of the list, like for scanned tracks followed by playlist ones
+    groups = groups or ()
+    result = TrackGroups()
+    for i, track_id in enumerate(tracks):
+        result.add(groups[i] if i < len(groups) else group_key(table.path(track_id), group_by), track_id)
+    return result
+
+
+class LibraryIndex:
+    def __init__(self, fp: str, formats: list, group_by: str = 'filename', search_tags: bool = False) -> None:
+        self.fp = fp
+        self.version = 4
+        self.formats = sorted(formats)
+        self.group_by = group_by
+        self.search_tags = search_tags
+        # dir path -> (dir mtime, names, mtimes, sizes, groups, tag texts, ((sub dir path, is symlink), ...))
+        self.dirs = {}
+        self.dirty = False
+        self.loaded = False
+
+    def load(self) -> None:
+        if self.loaded:
+            return
+        self.loaded = True
+        if not os.path.isfile(self.fp):
+            return
+        # Marshal only holds plain data, so a cache file can't run code. Anything odd in it means a full scan.
+        try:
+            f = open(self.fp, 'rb')
+            try:
+                content = marshal.load(f)
+            finally:
+                f.close()
+            if content.get('version') == self.version and content.get('formats') == self.formats and\
+                    content.get('group_by') == self.group_by and content.get('search_tags') == self.search_tags:
+                dirs = content['dirs']
+                if not isinstance(dirs, dict):
+                    raise ValueError('Bad dirs')
+                self.dirs = dirs
+        except Exception as _err:
+            log.warn('Failed to load library index, rescanning:', _err)
+            self.dirs = {}
+
+    def save(self) -> None:
+        if not self.dirty:
+            return
+        try:
+            f = open(self.fp + '.tmp', 'wb')
+            marshal.dump({
+                'version': self.version, 'formats': self.formats, 'group_by': self.group_by,
+                'search_tags': self.search_tags, 'dirs': self.dirs
+            }, f)
+            f.close()
+            os.replace(self.fp + '.tmp', self.fp)
+        except OSError as _err:
+            log.warn('Failed to save library index:', _err)
+            return
+        self.dirty = False
+
+    def unload(self) -> None:
+        # The names are in the track table by now, so don't keep a second copy around between scans
+        self.save()
+        self.dirs = {}
+        self.loaded = False
+
+
+class ScanPool:
+    def __init__(self, workers: int) -> None:
+        # Like a thread pool executor, but with daemon threads: a worker stuck on a hung mount is never joined,
+        # neither when the scan times out nor at interpreter exit
+        self.tasks = queue.SimpleQueue()
+        self.cancelled = False
+        self.threads = [threading.Thread(target=self.worker, daemon=True) for _i in range(max(workers, 1))]
+        for thread in self.threads:
+            thread.start()
+
+    def worker(self) -> None:
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                return
+            func, args, on_done = task
+            if self.cancelled:
+                continue
+            try:
+                on_done((func(*args), None))
+            except Exception as _err:
+                on_done((None, _err))
+
+    def submit(self, func: any, args: tuple, on_done: any) -> None:
+        self.tasks.put((func, args, on_done))
+
+    def shutdown(self) -> None:
+        # Queued tasks are skipped, running ones finish in the background
+        self.cancelled = True
+        for _thread in self.threads:
+            self.tasks.put(None)
+
+
+def scan_dir(path: str, formats: set, cached: tuple = None, with_stat: bool = False,
+             group_by: str = 'filename', dir_stat: os.stat_result = None, search_tags: bool = False) -> tuple:
+    dir_mtime = (dir_stat or os.stat(path)).st_mtime_ns
+    if cached and cached[0] == dir_mtime:
+        return cached, False
+    # Tags of files that didn't change since the last scan don't need to be read again
+    cached_files = {}
+    if cached and (search_tags or not group_by == 'filename'):
+        cached_files = {_name: _i for _i, _name in enumerate(cached[1])}
+    files = []
+    sub_dirs = []
+    with os.scandir(path) as it:
+        for entry in it:
+            # DirEntry uses d_type, so only symlinks need a stat here on most filesystems
+            if entry.is_dir():
+                sub_dirs.append((entry.path, entry.is_symlink()))
+            elif entry.name.split('.')[-1].lower() in formats:
+                if with_stat:
+                    try:
+                        stat = entry.stat()
+                    except OSError:  # Like a dangling symlink, the rest of the dir is still scanned
+                        continue
+                    i = cached_files.get(entry.name)
+                    if i is not None and cached[2][i] == stat.st_mtime_ns and cached[3][i] == stat.st_size:
+                        music_group, text = cached[4][i], cached[5][i]
+                    else:
+                        music_group, text = track_info(entry.path, group_by, search_tags)
+                    files.append((entry.name, stat.st_mtime_ns, stat.st_size, music_group, text))
+                else:
+                    files.append((entry.name, 0, 0) + track_info(entry.path, group_by, search_tags))
+    files.sort()
+    sub_dirs.sort()
+    # Column layout, so building the track list is a few list extends per dir
+    return (dir_mtime, ) + (tuple(zip(*files)) if files else ((), (), (), (), ())) + (tuple(sub_dirs), ), True
+
+
+def scan(roots: list, formats: list, threads: int = 8, timeout: float = 0.0, recursive: bool = True,
+         index: LibraryIndex = None, group_by: str = 'filename', table: track_table.TrackTable = None,
+         search_tags: bool = False) -> tuple:
+    # Tracks are IDs in table if it's given, full paths otherwise
+    start_time = time.monotonic()
+    if index:
+        index.load()
+    formats = set(formats)
+    pool = ScanPool(threads)
+    done_queue = queue.SimpleQueue()
+    pending_count = {}
+    deadlines = {}
+    found = {}
+    # (st_dev, st_ino) of every dir, so a dir reached directly and through a symlink (or a loop) is scanned once
+    visited = set()
+    visited_lock = threading.Lock()
+    scanned_dirs = {}
+    metrics = {'dirs': 0, 'changed_dirs': 0, 'tracks': 0, 'time': 0.0, 'root_times': {}, 'timed_out': []}
+
+    def scan_task(_root: str, _path: str) -> tuple:
+        # Dirs we already know are just a stat, so walk them inline instead of paying for a pool task each
+        _results = []
+        _spill = []
+        _stack = [_path]
+        while _stack and len(_results) < 256 and _root not in metrics['timed_out']:
+            _dir_path = _stack.pop()
+            try:
+                _dir_stat = os.stat(_dir_path)
+                with visited_lock:
+                    if (_dir_stat.st_dev, _dir_stat.st_ino) in visited:
+                        continue
+                    visited.add((_dir_stat.st_dev, _dir_stat.st_ino))
+                _dir_entry, _changed = scan_dir(
+                    _dir_path, formats, index.dirs.get(_dir_path) if index else None, bool(index), group_by, _dir_stat,
+                    search_tags
+                )
+            except OSError as _err:
+                log.warn('Failed to scan directory:', _err)
+                continue
+            _results.append((_dir_path, _dir_entry, _changed))
+            for _sub_dir in (_dir_entry[6] if recursive else ()):
+                if _sub_dir[1] or not (index and _sub_dir[0] in index.dirs):
+                    _spill.append(_sub_dir)
+                else:
+                    _stack.append(_sub_dir[0])
+        _spill.extend((_dir_path, False) for _dir_path in _stack)
+        return _results, _spill
+
+    def submit(_root: str, _path: str) -> None:
+        pending_count[_root] += 1
+        pool.submit(scan_task, (_root, _path), lambda _result: done_queue.put((_root, _result)))
+
+    for root in roots:
+        found[root] = []
+        pending_count[root] = 0
+        deadlines[root] = start_time + timeout if timeout > 0 else None
+        submit(root, root)
+    while any(pending_count.values()):
+        active_deadlines = [deadlines[_root] for _root, _count in pending_count.items() if _count and deadlines[_root]]
+        try:
+            root, (result, err) = done_queue.get(
+                timeout=max(min(active_deadlines) - time.monotonic(), 0.0) if active_deadlines else None
+            )
+        except queue.Empty:
+            now = time.monotonic()
+            for root in [_root for _root, _count in pending_count.items() if _count and deadlines[_root]]:
+                if now < deadlines[root]:
+                    continue
+                # Probably a hung network mount, keep what we have and don't wait for it
+                log.warn(f'Scanning "{root}" timed out after {timeout} seconds, results are incomplete')
+                metrics['timed_out'].append(root)
+                metrics['root_times'][root] = now - start_time
+                pending_count[root] = 0
+            continue
+        if root in metrics['timed_out']:
+            continue
+        pending_count[root] -= 1
+        if err:
+            pool.shutdown()
+            raise err
+        results, sub_dirs = result
+        for path, dir_entry, changed in results:
+            metrics['dirs'] += 1
+            scanned_dirs[path] = dir_entry
+            if changed:
+                metrics['changed_dirs'] += 1
+            found[root].append((path, dir_entry))
+        for sub_dir, _is_link in sub_dirs:
+            submit(root, sub_dir)
+        if not pending_count[root]:
+            metrics['root_times'][root] = time.monotonic() - start_time
+    pool.shutdown()
+    if index and (metrics['changed_dirs'] or not len(scanned_dirs) == len(index.dirs)):
+        if metrics['timed_out']:
+            index.dirs.update(scanned_dirs)  # Keep what we know about the dirs we didn't reach
+        else:
+            index.dirs = scanned_dirs
+        index.dirty = True
+    tracks = array.array('I') if table is not None else []
+    groups = []
+    texts = []
+    for root in roots:
+        for path, dir_entry in sorted(found[root], key=lambda _dir: _dir[0]):
+            dir_prefix = os.path.join(path, '')
+            if table is not None:
+                tracks.extend(table.add_dir(dir_prefix, dir_entry[1]))
+            else:
+                tracks.extend([dir_prefix + _name for _name in dir_entry[1]])
+            groups.extend(dir_entry[4])
+            texts.extend(dir_entry[5])
+    metrics['tracks'] = len(tracks)
+    metrics['time'] = time.monotonic() - start_time
+    return tracks, groups, texts, metrics
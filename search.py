@@ -0,0 +1,165 @@
+import re
+import array
+import bisect
+import track_table
+
+
+# Lowercase letters and digits stay, other ASCII bytes split words
+ASCII_WORDS = bytes(_c if chr(_c).isalnum() or _c > 127 else 32 for _c in range(256)).lower()
+WORD_RE = re.compile(r'[^\W_]+')
+
+
+def tokenize(text: any) -> list:
+    # Words are UTF-8 bytes, the ASCII case skips the regex and is several times faster
+    if isinstance(text, str):
+        if not text.isascii():
+            return [_word.encode('utf-8', 'surrogateescape') for _word in WORD_RE.findall(text.casefold())]
+        text = text.encode('ascii')
+    elif not text.isascii():
+        return tokenize(text.decode('utf-8', 'surrogateescape'))
+    return text.translate(ASCII_WORDS).split()
+
+
+class SearchIndex:
+    def __init__(self, table: track_table.TrackTable) -> None:
+        # Tracks of every word are stored back to back in the order of the sorted words, so all tracks for a prefix
+        # are one slice. Tracks added later go to small per word arrays, removed ones are filtered out.
+        self.table = table
+        self.words = []
+        self.offsets = array.array('Q', [0])
+        self.tracks = array.array('I')
+        self.new_words = []
+        self.new_tracks = {}
+        self.removed = set()
+        # Artist, album and title of each track, kept as UTF-8 in one buffer like the names in the track table
+        self.tag_buf = bytearray()
+        self.tag_starts = array.array('Q')
+        self.tag_ends = array.array('Q')
+        # Words from group keys (artist/album tags) point to the keys, tracks are taken from the live groups
+        self.group_words = []
+        self.groups = {}
+        self.group_keys = set()
+
+    def track_words(self, track_id: int) -> set:
+        name_ends = self.table.name_ends
+        name = bytes(self.table.names[name_ends[track_id]:name_ends[track_id + 1]])
+        words = set(tokenize(name.rpartition(b'.')[0] or name))
+        words.update(tokenize(self.tags(track_id)))
+        return words
+
+    def tags(self, track_id: int) -> bytes:
+        if track_id >= len(self.tag_starts):
+            return b''
+        return bytes(self.tag_buf[self.tag_starts[track_id]:self.tag_ends[track_id]])
+
+    def set_tags(self, track_id: int, text: str) -> None:
+        if not text and track_id >= len(self.tag_starts):
+            return
+        if track_id >= len(self.tag_starts):
+            missing = track_id + 1 - len(self.tag_starts)
+            self.tag_starts.extend(array.array('Q', bytes(8 * missing)))
+            self.tag_ends.extend(array.array('Q', bytes(8 * missing)))
+        self.tag_starts[track_id] = len(self.tag_buf)
+        self.tag_buf.extend(text.encode('utf-8', 'surrogateescape'))
+        self.tag_ends[track_id] = len(self.tag_buf)
+
+    def build(self, groups: any) -> None:
+        # Most words are rare, so a word with a single track keeps a plain int instead of an array
+        word_tracks = {}
+        for key, group_tracks in groups.items():
+            self.add_group(key)
+            for track_id in group_tracks:
+                for word in self.track_words(track_id):
+                    word_track = word_tracks.get(word)
+                    if word_track is None:
+                        word_tracks[word] = track_id
+                    elif type(word_track) is int:
+                        word_tracks[word] = array.array('I', (word_track, track_id))
+                    else:
+                        word_track.append(track_id)
+        self.words = sorted(word_tracks)
+        for word in self.words:
+            word_track = word_tracks.pop(word)
+            if type(word_track) is int:
+                self.tracks.append(word_track)
+            else:
+                self.tracks.extend(word_track)
+            self.offsets.append(len(self.tracks))
+
+    def add_group(self, key: str) -> None:
+        if key in self.group_keys:
+            return
+        self.group_keys.add(key)
+        for word in set(tokenize(key)):
+            if word in self.groups:
+                self.groups[word].append(key)
+            else:
+                self.groups[word] = [key]
+                bisect.insort(self.group_words, word)
+
+    def add(self, track_id: int, group_key: str, text: str = '') -> None:
+        self.add_group(group_key)
+        old_words = set(tokenize(self.tags(track_id)))
+        self.set_tags(track_id, text)
+        words = self.track_words(track_id)
+        if track_id in self.removed:
+            # The old words are still indexed, only new tags of a changed file are missing
+            self.removed.remove(track_id)
+            words = set(tokenize(text)).difference(old_words)
+        for word in words:
+            if word in self.new_tracks:
+                self.new_tracks[word].append(track_id)
+            else:
+                self.new_tracks[word] = array.array('I', (track_id, ))
+                bisect.insort(self.new_words, word)
+
+    def remove(self, track_ids: set) -> None:
+        self.removed.update(track_ids)
+
+    @staticmethod
+    def prefix_range(words: list, prefix: bytes) -> tuple:
+        # No UTF-8 byte is 0xFF, so it sorts after every word with the prefix
+        start = bisect.bisect_left(words, prefix)
+        return start, bisect.bisect_left(words, prefix + b'\xff', start)
+
+    def match_count(self, prefix: bytes) -> int:
+        start, end = self.prefix_range(self.words, prefix)
+        return self.offsets[end] - self.offsets[start]
+
+    def match_word(self, prefix: bytes, groups: any) -> set:
+        start, end = self.prefix_range(self.words, prefix)
+        result = set(self.tracks[self.offsets[start]:self.offsets[end]])
+        start, end = self.prefix_range(self.new_words, prefix)
+        for word in self.new_words[start:end]:
+            result.update(self.new_tracks[word])
+        for group_tracks in self.match_groups(prefix, groups):
+            result.update(group_tracks)
+        return result
+
+    def match_groups(self, prefix: bytes, groups: any) -> list:
+        start, end = self.prefix_range(self.group_words, prefix)
+        # Groups can go away with their last track
+        return [groups[_key] for _word in self.group_words[start:end] for _key in self.groups[_word] if _key in groups]
+
+    def match_track(self, track_id: int, prefix: bytes, group_tracks: set) -> bool:
+        return track_id in group_tracks or any(_word.startswith(prefix) for _word in self.track_words(track_id))
+
+    def find(self, query: str, groups: any) -> list:
+        # Every query word has to be a prefix of some word of the track name, its tags or its group key
+        prefixes = sorted(set(tokenize(query)), key=self.match_count)
+        if not prefixes:
+            return []
+        result = self.match_word(prefixes[0], groups)
+        for prefix in prefixes[1:]:
+            if not result:
+                break
+            if self.match_count(prefix) < len(result) * 64:
+                result.intersection_update(self.match_word(prefix, groups))
+                continue
+            # Checking the few tracks left is cheaper than collecting all tracks of a common word
+            group_tracks = set()
+            for track_ids in self.match_groups(prefix, groups):
+                group_tracks.update(track_ids)
+            result = set(_id for _id in result if self.match_track(_id, prefix, group_tracks))
+        result.difference_update(self.removed)
+        return sorted(result)
@@ -0,0 +1,56 @@
+import random
+import collections
+
+
+class ShuffleBag:
+    def __init__(self, window: float = 0.1) -> None:
+        # Window below 1 is a share of the library, otherwise a track count
+        self.window = window
+        self.size = 0
+        self.pos = 0
+        # Fisher-Yates on demand: only the slots that were swapped are stored, the rest map to themselves
+        self.swaps = {}
+        self.recent = collections.deque()
+        self.recent_set = set()
+
+    def reset(self, size: int) -> None:
+        self.size = size
+        self.pos = 0
+        self.swaps.clear()
+
+    def forget_recent(self) -> None:
+        # Track IDs mean something else after a rescan
+        self.recent.clear()
+        self.recent_set.clear()
+
+    def grow(self, count: int = 1) -> None:
+        # New tracks go to the part of the bag that wasn't drawn yet
+        self.size += count
+
+    def window_size(self) -> int:
+        window = int(self.window * self.size) if self.window < 1 else int(self.window)
+        # With at most half of the library blocked, a draw succeeds at least every second try
+        return min(window, self.size // 2)
+
+    def pick(self, tracks: list) -> int:
+        if not self.size:
+            return -1
+        if self.pos >= self.size:
+            self.reset(self.size)
+        for _i in range(64):
+            j = random.randrange(self.pos, self.size)
+            value = self.swaps.get(j, j)
+            # Only the start of a new pass can hit tracks from the end of the previous one
+            if tracks[value] not in self.recent_set:
+                break
+        if j == self.pos:
+            self.swaps.pop(j, None)
+        else:
+            self.swaps[j] = self.swaps.pop(self.pos, self.pos)
+        self.pos += 1
+        self.recent.append(tracks[value])
+        self.recent_set.add(tracks[value])
+        window = self.window_size()
+        while len(self.recent) > window:
+            self.recent_set.discard(self.recent.popleft())
+        return value
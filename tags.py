@@ -0,0 +1,304 @@
+import os
+import mmap
+import struct
+
+
+mpeg_bitrates = {
+    (3, 1): (0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448),
+    (3, 2): (0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384),
+    (3, 3): (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    (2, 1): (0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256),
+    (2, 2): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+    (2, 3): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160)
+}
+mpeg_rates = {3: (44100, 48000, 32000), 2: (22050, 24000, 16000), 0: (11025, 12000, 8000)}
+id3_frames = {
+    b'TPE1': 'artist', b'TP1': 'artist', b'TALB': 'album', b'TAL': 'album', b'TIT2': 'title', b'TT2': 'title',
+    b'TLEN': 'duration', b'TLE': 'duration'
+}
+id3_encodings = ('latin-1', 'utf-16', 'utf-16-be', 'utf-8')
+vorbis_fields = {'ARTIST': 'artist', 'ALBUM': 'album', 'TITLE': 'title'}
+mp4_fields = {b'\xa9ART': 'artist', b'aART': 'artist', b'\xa9alb': 'album', b'\xa9nam': 'title'}
+mp4_containers = (b'moov', b'trak', b'mdia', b'udta', b'ilst')
+riff_fields = {b'IART': 'artist', b'IPRD': 'album', b'INAM': 'title'}
+u32_be = struct.Struct('>I')
+u32_le = struct.Struct('<I')
+
+
+def read_tags(fp: str) -> dict:
+    # Only the touched pages of the mapping are read, which is usually the first few KB and maybe the last one
+    result = {'artist': '', 'album': '', 'title': '', 'duration': 0.0, 'freq': 0}
+    try:
+        f = open(fp, 'rb')
+    except OSError:
+        return result
+    try:
+        size = os.fstat(f.fileno()).st_size
+        if size >= 16:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                parse_tags(buf, size, result)
+            finally:
+                buf.close()
+    except Exception:  # A broken or odd file just has no tags, it mustn't fail a whole scan
+        pass
+    finally:
+        f.close()
+    return result
+
+
+def parse_tags(buf: mmap.mmap, size: int, result: dict) -> None:
+    head = buf[:12]
+    if head[:4] == b'fLaC':
+        parse_flac(buf, 4, size, result)
+    elif head[:4] == b'OggS':
+        parse_ogg(buf, size, result)
+    elif head[4:8] == b'ftyp':
+        parse_mp4(buf, 0, size, result)
+    elif head[:4] == b'RIFF' and head[8:12] == b'WAVE':
+        parse_riff(buf, size, result)
+    else:
+        offset = parse_id3(buf, size, result) if head[:3] == b'ID3' else 0
+        if buf[offset:offset + 4] == b'fLaC':
+            parse_flac(buf, offset + 4, size, result)
+        else:
+            parse_mpeg(buf, offset, size, result)
+
+
+def decode_text(data: bytes, encoding: str = 'utf-8') -> str:
+    return data.decode(encoding, errors='replace').strip('\0').strip()
+
+
+def syncsafe(data: bytes) -> int:
+    return (data[0] << 21) | (data[1] << 14) | (data[2] << 7) | data[3]
+
+
+def parse_id3(buf: mmap.mmap, size: int, result: dict) -> int:
+    header = buf[:10]
+    version, flags = header[3], header[5]
+    end = min(10 + syncsafe(header[6:10]), size)
+    offset = 10
+    if flags & 0x40:  # Extended header
+        offset += syncsafe(buf[10:14]) if version >= 4 else u32_be.unpack(buf[10:14])[0] + 4
+    id_len, header_len = (3, 6) if version == 2 else (4, 10)
+    while offset + header_len <= end:
+        frame_header = buf[offset:offset + header_len]
+        frame_id = frame_header[:id_len]
+        if not frame_id.strip(b'\0'):
+            break  # Padding
+        if version == 2:
+            frame_size = int.from_bytes(frame_header[3:6], 'big')
+        elif version >= 4:
+            frame_size = syncsafe(frame_header[4:8])
+        else:
+            frame_size = u32_be.unpack(frame_header[4:8])[0]
+        offset += header_len
+        key = id3_frames.get(frame_id)
+        # Compressed and encrypted frames aren't worth it for a few text fields
+        if key and not (version >= 3 and frame_header[9] & (0x0C if version >= 4 else 0xC0)) and frame_size > 1:
+            data = buf[offset:offset + min(frame_size, 1024)]
+            if version >= 4 and frame_header[9] & 0x01:
+                data = data[4:]  # Data length indicator
+            value = decode_text(data[1:], id3_encodings[data[0]] if data[0] < 4 else 'latin-1')
+            if key == 'duration':
+                if value.isdigit():
+                    result[key] = int(value) / 1000
+            elif not result[key]:
+                result[key] = value.split('\0')[0]
+        offset += frame_size
+    return min(end + (10 if version >= 4 and flags & 0x10 else 0), size)
+
+
+def parse_id3v1(buf: mmap.mmap, size: int, result: dict) -> None:
+    if size < 128 or not buf[size - 128:size - 125] == b'TAG':
+        return
+    tag = buf[size - 128:size]
+    for key, start in (('title', 3), ('artist', 33), ('album', 63)):
+        if not result[key]:
+            result[key] = decode_text(tag[start:start + 30], 'latin-1')
+
+
+def parse_mpeg(buf: mmap.mmap, offset: int, size: int, result: dict) -> None:
+    # Find the first frame, there may be padding or junk after the ID3 tag
+    search_end = min(offset + 64 * 1024, size - 4)
+    while offset < search_end:
+        offset = buf.find(b'\xff', offset, search_end)
+        if offset < 0:
+            return
+        header = u32_be.unpack(buf[offset:offset + 4])[0]
+        version = (header >> 19) & 3
+        layer = 4 - ((header >> 17) & 3)
+        bitrate_id = (header >> 12) & 15
+        rate_id = (header >> 10) & 3
+        if header >> 21 == 0x7FF and not version == 1 and layer < 4 and 0 < bitrate_id < 15 and rate_id < 3:
+            break
+        offset += 1
+    else:
+        return
+    freq = mpeg_rates[version][rate_id]
+    bitrate = mpeg_bitrates[(3 if version == 3 else 2, layer)][bitrate_id] * 1000
+    mono = (header >> 6) & 3 == 3
+    if layer == 1:
+        frame_samples = 384
+    elif layer == 3 and not version == 3:
+        frame_samples = 576
+    else:
+        frame_samples = 1152
+    result['freq'] = freq
+    side_info = (17 if mono else 32) if version == 3 else (9 if mono else 17)
+    xing = offset + 4 + side_info
+    frame_count = 0
+    if buf[xing:xing + 4] in (b'Xing', b'Info'):
+        if u32_be.unpack(buf[xing + 4:xing + 8])[0] & 1:
+            frame_count = u32_be.unpack(buf[xing + 8:xing + 12])[0]
+    elif buf[offset + 36:offset + 40] == b'VBRI':
+        frame_count = u32_be.unpack(buf[offset + 50:offset + 54])[0]
+    if frame_count and freq:
+        result['duration'] = frame_count * frame_samples / freq
+    elif not result['duration'] and bitrate:
+        # Constant bitrate, so the size tells the length
+        audio_size = size - offset - (128 if buf[size - 128:size - 125] == b'TAG' else 0)
+        result['duration'] = audio_size * 8 / bitrate
+    parse_id3v1(buf, size, result)
+
+
+def parse_vorbis_comment(data: bytes, result: dict) -> None:
+    offset = 4 + u32_le.unpack_from(data, 0)[0]
+    count = u32_le.unpack_from(data, offset)[0]
+    offset += 4
+    for _i in range(count):
+        length = u32_le.unpack_from(data, offset)[0]
+        offset += 4
+        field = data[offset:offset + min(length, 1024)]
+        offset += length
+        key, sep, value = field.partition(b'=')
+        key = vorbis_fields.get(key.decode('ascii', errors='replace').upper())
+        if sep and key and not result[key]:
+            result[key] = decode_text(value)
+
+
+def parse_flac(buf: mmap.mmap, offset: int, size: int, result: dict) -> None:
+    is_last = False
+    while not is_last and offset + 4 <= size:
+        block_header = buf[offset:offset + 4]
+        is_last = bool(block_header[0] & 0x80)
+        block_type = block_header[0] & 0x7F
+        block_size = int.from_bytes(block_header[1:4], 'big')
+        offset += 4
+        if block_type == 0:
+            info = int.from_bytes(buf[offset + 10:offset + 18], 'big')
+            result['freq'] = info >> 44
+            if result['freq']:
+                result['duration'] = (info & 0xFFFFFFFFF) / result['freq']
+        elif block_type == 4:
+            parse_vorbis_comment(buf[offset:offset + block_size], result)
+            return
+        offset += block_size
+
+
+def parse_ogg(buf: mmap.mmap, size: int, result: dict) -> None:
+    # Join the segments of the first two packets (identification and comment headers)
+    packets = []
+    packet = []
+    offset = 0
+    serial = None
+    while len(packets) < 2 and buf[offset:offset + 4] == b'OggS' and offset < 512 * 1024:
+        page_serial = u32_le.unpack(buf[offset + 14:offset + 18])[0]
+        seg_count = buf[offset + 26]
+        segments = buf[offset + 27:offset + 27 + seg_count]
+        offset += 27 + seg_count
+        for seg_size in segments:
+            if page_serial == serial or serial is None:
+                packet.append(buf[offset:offset + seg_size])
+            offset += seg_size
+            if seg_size < 255 and (page_serial == serial or serial is None):
+                packets.append(b''.join(packet))
+                packet = []
+                serial = page_serial
+                if len(packets) >= 2:
+                    break
+    if not packets:
+        return
+    ident = packets[0]
+    if ident[:8] == b'OpusHead':
+        pre_skip = struct.unpack('<H', ident[10:12])[0]
+        result['freq'] = u32_le.unpack(ident[12:16])[0] or 48000
+        granule_rate = 48000
+        comment_magic = b'OpusTags'
+    elif ident[:7] == b'\x01vorbis':
+        pre_skip = 0
+        result['freq'] = granule_rate = u32_le.unpack(ident[12:16])[0]
+        comment_magic = b'\x03vorbis'
+    else:
+        return
+    if len(packets) > 1 and packets[1][:len(comment_magic)] == comment_magic:
+        parse_vorbis_comment(packets[1][len(comment_magic):], result)
+    # The granule position of the last page is the total sample count
+    offset = size
+    search_start = max(size - 64 * 1024, 0)
+    while offset > search_start:
+        offset = buf.rfind(b'OggS', search_start, offset)
+        if offset < 0 or offset + 27 > size:
+            return
+        granule = struct.unpack('<q', buf[offset + 6:offset + 14])[0]
+        if granule > 0 and granule_rate and u32_le.unpack(buf[offset + 14:offset + 18])[0] == serial:
+            result['duration'] = max(granule - pre_skip, 0) / granule_rate
+            return
+
+
+def parse_mp4(buf: mmap.mmap, offset: int, end: int, result: dict) -> None:
+    while offset + 8 <= end:
+        atom_size, atom_type = struct.unpack('>I4s', buf[offset:offset + 8])
+        header_size = 8
+        if atom_size == 1:
+            atom_size = struct.unpack('>Q', buf[offset + 8:offset + 16])[0]
+            header_size = 16
+        elif atom_size == 0:
+            atom_size = end - offset
+        if atom_size < header_size:
+            return
+        data = offset + header_size
+        atom_end = min(offset + atom_size, end)
+        if atom_type in mp4_containers:
+            parse_mp4(buf, data, atom_end, result)
+        elif atom_type == b'meta':
+            parse_mp4(buf, data + 4, atom_end, result)
+        elif atom_type in (b'mvhd', b'mdhd'):
+            if buf[data] == 1:
+                timescale, duration = struct.unpack('>IQ', buf[data + 20:data + 32])
+            else:
+                timescale, duration = struct.unpack('>II', buf[data + 12:data + 20])
+            if atom_type == b'mvhd' and timescale:
+                result['duration'] = duration / timescale
+            elif atom_type == b'mdhd' and not result['freq']:
+                result['freq'] = timescale  # Audio tracks use the sample rate as timescale
+        elif atom_type in mp4_fields:
+            key = mp4_fields[atom_type]
+            if buf[data + 4:data + 8] == b'data' and not result[key]:
+                data_size = u32_be.unpack(buf[data:data + 4])[0]
+                result[key] = decode_text(buf[data + 16:data + min(data_size, 1024)])
+        offset += atom_size
+
+
+def parse_riff(buf: mmap.mmap, size: int, result: dict) -> None:
+    offset = 12
+    byte_rate = 0
+    while offset + 8 <= size:
+        chunk_id = buf[offset:offset + 4]
+        chunk_size = u32_le.unpack(buf[offset + 4:offset + 8])[0]
+        data = offset + 8
+        if chunk_id == b'fmt ':
+            result['freq'], byte_rate = struct.unpack('<II', buf[data + 4:data + 12])
+        elif chunk_id == b'data':
+            if byte_rate:
+                result['duration'] = min(chunk_size, size - data) / byte_rate
+        elif chunk_id == b'LIST' and buf[data:data + 4] == b'INFO':
+            sub_offset = data + 4
+            while sub_offset + 8 <= data + chunk_size:
+                sub_id = buf[sub_offset:sub_offset + 4]
+                sub_size = u32_le.unpack(buf[sub_offset + 4:sub_offset + 8])[0]
+                key = riff_fields.get(sub_id)
+                if key and not result[key]:
+                    result[key] = decode_text(buf[sub_offset + 8:sub_offset + 8 + min(sub_size, 1024)], 'latin-1')
+                sub_offset += 8 + sub_size + (sub_size & 1)
+        offset = data + chunk_size + (chunk_size & 1)
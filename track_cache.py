@@ -0,0 +1,204 @@
+import os
+import json
+import threading
+import subprocess
+import concurrent.futures
+import log
+
+
+def probe_track(fp: str) -> list:
+    # Returns the stat key of a definitely broken file (unreadable or empty), None otherwise.
+    # Headers vary too much (junk before MP3 frames, MP4 atoms before ftyp), so the rest is left to the backend.
+    try:
+        f = open(fp, 'rb')
+    except OSError:  # A file that is gone has no key and isn't blacklisted
+        return BadTrackCache.safe_stat_key(fp)
+    try:
+        stat = os.fstat(f.fileno())
+        key = [stat.st_mtime_ns, stat.st_size]
+        if not stat.st_size:
+            return key
+        # Bad sectors and dead network files fail to read at the start or the end
+        f.read(65536)
+        if stat.st_size > 65536:
+            f.seek(-65536, os.SEEK_END)
+            f.read(65536)
+    except OSError:
+        return BadTrackCache.safe_stat_key(fp)
+    finally:
+        f.close()
+    return None
+
+
+def probe_duration(fp: str, encoding: str = 'utf-8') -> float:
+    result: str = subprocess.check_output([
+        'ffprobe', '-i', fp, '-show_entries', 'format=duration', '-v', 'quiet'
+    ], shell=False, encoding=encoding)
+    return float(result.split('\n')[1].split('=')[-1])
+
+
+class BadTrackCache:
+    def __init__(self, fp: str, encoding: str = 'utf-8') -> None:
+        self.fp = fp
+        self.encoding = encoding
+        self.tracks = {}
+        self.dirty = False
+        self.lock = threading.Lock()
+        if os.path.isfile(self.fp):
+            try:
+                f = open(self.fp, 'r', encoding=self.encoding)
+                self.tracks = json.loads(f.read())
+                f.close()
+            except (OSError, ValueError) as _err:
+                log.warn('Failed to load bad track cache:', _err)
+
+    @staticmethod
+    def stat_key(track_fp: str) -> list:
+        stat = os.stat(track_fp)
+        return [stat.st_mtime_ns, stat.st_size]
+
+    @staticmethod
+    def safe_stat_key(track_fp: str) -> list:
+        try:
+            return BadTrackCache.stat_key(track_fp)
+        except OSError:
+            return None
+
+    def is_bad(self, track_fp: str) -> bool:
+        with self.lock:
+            key = self.tracks.get(track_fp)
+            if not key:
+                return False
+            try:
+                if self.stat_key(track_fp) == key:
+                    return True
+            except OSError:
+                return True
+            # The file was changed since it failed, so give it another chance
+            del self.tracks[track_fp]
+            self.dirty = True
+            return False
+
+    def add(self, track_fp: str, key: list = None) -> None:
+        if key is None:
+            key = self.safe_stat_key(track_fp)
+            if key is None:
+                return
+        with self.lock:
+            self.tracks[track_fp] = key
+            self.dirty = True
+
+    def save(self) -> None:
+        with self.lock:
+            if not self.dirty:
+                return
+            content = json.dumps(self.tracks)
+            self.dirty = False
+        try:
+            f = open(self.fp, 'w', encoding=self.encoding)
+            f.write(content)
+            f.close()
+        except OSError as _err:
+            log.warn('Failed to save bad track cache:', _err)
+
+    def validate(self, tracks: list, on_done: any, workers: int = 0) -> None:
+        # on_done gets a list of (path, stat key) on the validate thread, the main loop adds them with add
+        threading.Thread(
+            target=self.validate_thread, args=(tuple(tracks), on_done, workers or None), daemon=True
+        ).start()
+
+    @staticmethod
+    def validate_thread(tracks: tuple, on_done: any, workers: int) -> None:
+        bad = []
+        try:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+                for track_fp, key in zip(tracks, executor.map(probe_track, tracks, chunksize=256)):
+                    if key is not None:
+                        bad.append((track_fp, key))
+        except (OSError, RuntimeError) as _err:
+            log.warn('Failed to validate library:', _err)
+            return
+        log.info('Library validated:', len(bad), 'bad tracks out of', len(tracks))
+        on_done(bad)
+
+
+class DurationCache:
+    def __init__(self, fp: str, encoding: str = 'utf-8', workers: int = 2) -> None:
+        self.fp = fp
+        self.encoding = encoding
+        # path -> [mtime, size, duration]
+        self.durations = {}
+        self.pending = {}
+        self.available = True
+        self.dirty = False
+        self.lock = threading.Lock()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(workers, 1))
+        if os.path.isfile(self.fp):
+            try:
+                f = open(self.fp, 'r', encoding=self.encoding)
+                self.durations = json.loads(f.read())
+                f.close()
+            except (OSError, ValueError) as _err:
+                log.warn('Failed to load duration cache:', _err)
+
+    def get(self, track_fp: str, callback: any = None) -> float:
+        # Returns 0.0 when the duration isn't known yet, callback gets it once ffprobe is done
+        try:
+            key = BadTrackCache.stat_key(track_fp)
+        except OSError:
+            return 0.0
+        with self.lock:
+            entry = self.durations.get(track_fp)
+            if entry and entry[:2] == key:
+                return entry[2]
+            if not self.available:
+                return 0.0
+            if track_fp in self.pending:
+                if callback:
+                    self.pending[track_fp].append(callback)
+                return 0.0
+            self.pending[track_fp] = [callback] if callback else []
+        try:
+            self.executor.submit(self.probe_thread, track_fp, key)
+        except RuntimeError:
+            with self.lock:
+                self.pending.pop(track_fp, None)
+        return 0.0
+
+    def probe_thread(self, track_fp: str, key: list) -> None:
+        try:
+            length = probe_duration(track_fp, self.encoding)
+        except OSError as _err:
+            log.warn('Failed to run ffprobe:', _err)
+            self.available = False
+            length = None
+        except (subprocess.CalledProcessError, ValueError, IndexError) as _err:
+            log.warn(f'Failed to get music length of "{track_fp}": {_err}')
+            length = 0.0
+        with self.lock:
+            callbacks = self.pending.pop(track_fp, ())
+            if length is None:
+                return
+            # Failures are cached too, so a broken file doesn't fork ffprobe on every play
+            self.durations[track_fp] = key + [length]
+            self.dirty = True
+        if length > 0:
+            for callback in callbacks:
+                callback(length)
+
+    def save(self) -> None:
+        with self.lock:
+            if not self.dirty:
+                return
+            content = json.dumps(self.durations)
+            self.dirty = False
+        try:
+            f = open(self.fp, 'w', encoding=self.encoding)
+            f.write(content)
+            f.close()
+        except OSError as _err:
+            log.warn('Failed to save duration cache:', _err)
+
+    def destroy(self) -> None:
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.save()
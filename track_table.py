@@ -0,0 +1,121 @@
+import os
+import array
+import itertools
+
+
+class TrackTable:
+    def __init__(self) -> None:
+        # Tracks are integer IDs: dir prefixes are stored once, basenames back to back in one buffer
+        self.dirs = []
+        self.dir_ids = {}
+        self.dir_tracks = []
+        self.names = bytearray()
+        self.name_ends = array.array('Q', [0])
+        self.track_dirs = array.array('I')
+
+    def __len__(self) -> int:
+        return len(self.track_dirs)
+
+    def get_dir(self, prefix: str) -> int:
+        dir_id = self.dir_ids.get(prefix)
+        if dir_id is None:
+            dir_id = self.dir_ids[prefix] = len(self.dirs)
+            self.dirs.append(prefix)
+            self.dir_tracks.append(array.array('I'))
+        return dir_id
+
+    def add_dir(self, prefix: str, names: tuple) -> range:
+        # Prefix must end with a separator (or be empty), like os.path.join(path, '')
+        dir_id = self.get_dir(prefix)
+        start = len(self.track_dirs)
+        encoded = [_name.encode('utf-8', 'surrogateescape') for _name in names]
+        self.names += b''.join(encoded)
+        # Skip the initial value, it's already the end of the previous name
+        self.name_ends.extend(
+            itertools.islice(itertools.accumulate(map(len, encoded), initial=self.name_ends[-1]), 1, None)
+        )
+        self.track_dirs.extend(itertools.repeat(dir_id, len(encoded)))
+        result = range(start, start + len(encoded))
+        self.dir_tracks[dir_id].extend(result)
+        return result
+
+    @staticmethod
+    def split(fp: str) -> tuple:
+        name = os.path.basename(fp)
+        return fp[:len(fp) - len(name)], name
+
+    def find(self, fp: str) -> int:
+        prefix, name = self.split(fp)
+        dir_id = self.dir_ids.get(prefix)
+        if dir_id is None:
+            return -1
+        encoded = name.encode('utf-8', 'surrogateescape')
+        name_ends = self.name_ends
+        for track_id in self.dir_tracks[dir_id]:
+            start = name_ends[track_id]
+            if name_ends[track_id + 1] - start == len(encoded) and self.names[start:start + len(encoded)] == encoded:
+                return track_id
+        return -1
+
+    def add(self, fp: str) -> int:
+        track_id = self.find(fp)
+        if track_id < 0:
+            prefix, name = self.split(fp)
+            track_id = self.add_dir(prefix, (name, ))[0]
+        return track_id
+
+    def add_paths(self, fps: any, chunk_size: int = 4096, cache_size: int = 65536) -> any:
+        # Like add for every path, but find is linear in the dir size, so known names are looked up in a dict.
+        # Paths are consumed in chunks and the dict is dropped once it's big, so long iterables are never held whole.
+        it = iter(fps)
+        known = {}
+        cached = 0
+        while True:
+            chunk = [self.split(_fp) for _fp in itertools.islice(it, chunk_size)]
+            if not chunk:
+                return
+            if cached > cache_size:
+                known.clear()
+                cached = 0
+            new = {}
+            for prefix, name in chunk:
+                names = known.get(prefix)
+                if names is None:
+                    dir_id = self.dir_ids.get(prefix)
+                    names = known[prefix] = {} if dir_id is None else {
+                        self.name(_track_id): _track_id for _track_id in self.dir_tracks[dir_id]
+                    }
+                    cached += len(names)
+                if name not in names:
+                    # New names of a dir are added at once
+                    names[name] = -1
+                    new.setdefault(prefix, []).append(name)
+            for prefix, new_names in new.items():
+                known[prefix].update(zip(new_names, self.add_dir(prefix, new_names)))
+                cached += len(new_names)
+            for prefix, name in chunk:
+                yield known[prefix][name]
+
+    def name(self, track_id: int) -> str:
+        return self.names[self.name_ends[track_id]:self.name_ends[track_id + 1]].decode('utf-8', 'surrogateescape')
+
+    def path(self, track_id: int) -> str:
+        return self.dirs[self.track_dirs[track_id]] + self.name(track_id)
+
+    def paths(self, track_ids: any) -> any:
+        return (self.path(_track_id) for _track_id in track_ids)
+
+    def map_ids(self, other: 'TrackTable') -> array.array:
+        # IDs here of the tracks of the other table, -1 for the ones that are missing. Goes dir by dir, so the cost
+        # doesn't depend on the order of the tracks. The other table may still be growing, later tracks are skipped.
+        size = len(other)
+        result = array.array('i', [-1]) * size
+        for other_dir_id in range(len(other.dirs)):
+            dir_id = self.dir_ids.get(other.dirs[other_dir_id])
+            if dir_id is None:
+                continue
+            names = {self.name(_track_id): _track_id for _track_id in self.dir_tracks[dir_id]}
+            for track_id in other.dir_tracks[other_dir_id]:
+                if track_id < size:
+                    result[track_id] = names.get(other.name(track_id), -1)
+        return result
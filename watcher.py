@@ -0,0 +1,309 @@
+import os
+import sys
+import errno
+import ctypes
+import select
+import struct
+import threading
+import log
+
+
+class BaseWatcher:
+    def __init__(self, roots: list, formats: list, tracks: list, on_change: any, recursive: bool = True) -> None:
+        # Same form as the dir part of the scanned paths, so 'music/' and 'music' both work
+        self.roots = [os.path.dirname(os.path.join(_root, '')) for _root in roots]
+        self.formats = set(formats)
+        self.recursive = recursive
+        self.visited = set()
+        self.on_change = on_change
+        self.lock = threading.Lock()
+        self.deltas = []
+        # dir path -> set of track names, owned by the watcher thread and filled there from tracks
+        self.dirs = {}
+        self.tracks = tracks
+        self.running = True
+        self.thread = threading.Thread(target=self.watch_thread, daemon=True)
+
+    def start(self) -> None:
+        self.thread.start()
+
+    def watch_thread(self) -> None:
+        pass
+
+    def load_tracks(self) -> None:
+        for track_fp in self.tracks:
+            dir_path, fn = os.path.split(track_fp)
+            if dir_path in self.dirs:
+                self.dirs[dir_path].add(fn)
+            else:
+                self.dirs[dir_path] = {fn}
+        self.tracks = None
+
+    def watch_dir(self, dir_path: str) -> None:
+        pass
+
+    def is_track(self, fn: str) -> bool:
+        return fn.split('.')[-1].lower() in self.formats
+
+    def push(self, action: str, track_fp: str) -> None:
+        with self.lock:
+            self.deltas.append((action, track_fp))
+        on_change = self.on_change
+        if on_change:
+            on_change()
+
+    def pop_deltas(self) -> list:
+        with self.lock:
+            result = self.deltas
+            self.deltas = []
+        return result
+
+    def add_track(self, dir_path: str, fn: str) -> None:
+        names = self.dirs.get(dir_path)
+        if names is None:
+            names = self.dirs[dir_path] = set()
+        if fn in names:
+            return
+        names.add(fn)
+        self.push('add', os.path.join(dir_path, fn))
+
+    def remove_track(self, dir_path: str, fn: str) -> None:
+        names = self.dirs.get(dir_path)
+        if not names or fn not in names:
+            return
+        names.remove(fn)
+        self.push('remove', os.path.join(dir_path, fn))
+
+    def scan_tree(self, root: str) -> None:
+        stack = [root]
+        while stack and self.running:
+            dir_path = stack.pop()
+            self.watch_dir(dir_path)
+            try:
+                with os.scandir(dir_path) as it:
+                    entries = [(entry.name, entry.is_dir(), entry.is_symlink()) for entry in it]
+            except OSError as _err:
+                log.warn('Failed to scan directory:', _err)
+                continue
+            names = set()
+            for fn, is_dir, is_link in entries:
+                if is_dir:
+                    if self.recursive and self.should_follow(os.path.join(dir_path, fn), is_link):
+                        stack.append(os.path.join(dir_path, fn))
+                elif self.is_track(fn):
+                    names.add(fn)
+                    self.add_track(dir_path, fn)
+            for fn in tuple(self.dirs.get(dir_path) or ()):
+                if fn not in names:
+                    self.remove_track(dir_path, fn)
+
+    def should_follow(self, dir_path: str, is_link: bool) -> bool:
+        if not is_link:
+            return True
+        real_path = os.path.realpath(dir_path)
+        if real_path in self.visited:  # Don't follow symlink loops
+            return False
+        self.visited.add(real_path)
+        return True
+
+    def forget_tree(self, root: str) -> None:
+        prefix = os.path.join(root, '')
+        for dir_path in [_dir for _dir in self.dirs if _dir == root or _dir.startswith(prefix)]:
+            for fn in tuple(self.dirs[dir_path]):
+                self.remove_track(dir_path, fn)
+            del self.dirs[dir_path]
+
+    def destroy(self) -> None:
+        self.running = False
+        self.on_change = None
+
+
+class PollWatcher(BaseWatcher):
+    def __init__(self, roots: list, formats: list, tracks: list, on_change: any, recursive: bool = True,
+                 interval: float = 5.0) -> None:
+        super().__init__(roots, formats, tracks, on_change, recursive)
+        self.interval = interval
+        self.mtimes = {}
+        self.stop_event = threading.Event()
+
+    def watch_dir(self, dir_path: str) -> None:
+        try:
+            self.mtimes[dir_path] = os.stat(dir_path).st_mtime_ns
+        except OSError:
+            self.mtimes.pop(dir_path, None)
+
+    def watch_thread(self) -> None:
+        self.load_tracks()
+        for root in self.roots:
+            self.scan_tree(root)
+        while not self.stop_event.wait(self.interval):
+            # Only dirs whose mtime changed are listed again
+            for dir_path, mtime in tuple(self.mtimes.items()):
+                if not self.running:
+                    return
+                try:
+                    new_mtime = os.stat(dir_path).st_mtime_ns
+                except OSError:
+                    del self.mtimes[dir_path]
+                    self.forget_tree(dir_path)
+                    continue
+                if not new_mtime == mtime:
+                    self.mtimes[dir_path] = new_mtime
+                    self.rescan_dir(dir_path)
+
+    def rescan_dir(self, dir_path: str) -> None:
+        try:
+            with os.scandir(dir_path) as it:
+                entries = [(entry.name, entry.is_dir(), entry.is_symlink()) for entry in it]
+        except OSError as _err:
+            log.warn('Failed to scan directory:', _err)
+            return
+        names = set()
+        for fn, is_dir, is_link in entries:
+            sub_dir = os.path.join(dir_path, fn)
+            if is_dir:
+                if self.recursive and sub_dir not in self.mtimes and self.should_follow(sub_dir, is_link):
+                    self.scan_tree(sub_dir)
+            elif self.is_track(fn):
+                names.add(fn)
+                self.add_track(dir_path, fn)
+        for fn in tuple(self.dirs.get(dir_path) or ()):
+            if fn not in names:
+                self.remove_track(dir_path, fn)
+
+    def destroy(self) -> None:
+        super().destroy()
+        self.stop_event.set()
+
+
+class InotifyWatcher(BaseWatcher):
+    def __init__(self, roots: list, formats: list, tracks: list, on_change: any, recursive: bool = True) -> None:
+        super().__init__(roots, formats, tracks, on_change, recursive)
+        self.IN_CLOSE_WRITE = 0x00000008
+        self.IN_MOVED_FROM = 0x00000040
+        self.IN_MOVED_TO = 0x00000080
+        self.IN_CREATE = 0x00000100
+        self.IN_DELETE = 0x00000200
+        self.IN_DELETE_SELF = 0x00000400
+        self.IN_MOVE_SELF = 0x00000800
+        self.IN_Q_OVERFLOW = 0x00004000
+        self.IN_IGNORED = 0x00008000
+        self.IN_ONLYDIR = 0x01000000
+        self.IN_ISDIR = 0x40000000
+        self.IN_NONBLOCK = 0o4000
+        self.IN_CLOEXEC = 0o2000000
+        self.watch_mask = (
+            self.IN_CLOSE_WRITE | self.IN_MOVED_FROM | self.IN_MOVED_TO | self.IN_CREATE | self.IN_DELETE |
+            self.IN_DELETE_SELF | self.IN_MOVE_SELF | self.IN_ONLYDIR
+        )
+        self.event_header = struct.Struct('iIII')
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        self.libc.inotify_init1.argtypes = (ctypes.c_int, )
+        self.libc.inotify_init1.restype = ctypes.c_int
+        self.libc.inotify_add_watch.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32)
+        self.libc.inotify_add_watch.restype = ctypes.c_int
+        self.fd = self.libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self.fd < 0:
+            raise RuntimeError(f'Failed to init inotify ({os.strerror(ctypes.get_errno())})')
+        self.wd_map = {}
+        self.out_of_watches = False
+        self.stop_r, self.stop_w = os.pipe()
+        # The watcher thread closes the fds itself once it's out of every inotify call, destroy doesn't wait for it
+        self.fd_lock = threading.Lock()
+
+    def watch_dir(self, dir_path: str) -> None:
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(dir_path), self.watch_mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err == errno.ENOSPC:
+                if self.out_of_watches:
+                    return
+                self.out_of_watches = True
+                log.warn('Too many inotify watches, raise fs.inotify.max_user_watches')
+            elif not err == errno.ENOENT:
+                log.warn(f'Failed to watch "{dir_path}" ({os.strerror(err)})')
+            return
+        self.wd_map[wd] = dir_path
+
+    def watch_thread(self) -> None:
+        try:
+            self.watch_loop()
+        finally:
+            with self.fd_lock:
+                os.close(self.fd)
+                os.close(self.stop_r)
+                os.close(self.stop_w)
+                self.stop_w = -1
+
+    def watch_loop(self) -> None:
+        self.load_tracks()
+        for root in self.roots:
+            self.scan_tree(root)
+        while self.running:
+            try:
+                ready, _, _ = select.select((self.fd, self.stop_r), (), ())
+                if self.stop_r in ready:
+                    return
+                buf = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                continue
+            except OSError:
+                return
+            offset = 0
+            while offset < len(buf):
+                wd, mask, cookie, name_len = self.event_header.unpack_from(buf, offset)
+                offset += self.event_header.size
+                fn = os.fsdecode(buf[offset:offset + name_len].rstrip(b'\0'))
+                offset += name_len
+                self.handle_event(wd, mask, fn)
+
+    def handle_event(self, wd: int, mask: int, fn: str) -> None:
+        if mask & self.IN_Q_OVERFLOW:
+            log.warn('Inotify queue overflow, rescanning library')
+            for root in self.roots:
+                self.scan_tree(root)
+            return
+        dir_path = self.wd_map.get(wd)
+        if dir_path is None:
+            return
+        if mask & self.IN_IGNORED:
+            del self.wd_map[wd]
+            return
+        if mask & (self.IN_DELETE_SELF | self.IN_MOVE_SELF):
+            self.forget_tree(dir_path)
+            return
+        if mask & self.IN_ISDIR:
+            if not self.recursive:
+                return
+            if mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                self.scan_tree(os.path.join(dir_path, fn))
+            elif mask & self.IN_MOVED_FROM:
+                self.forget_tree(os.path.join(dir_path, fn))
+            return
+        if not self.is_track(fn):
+            return
+        # Tracks are added when fully written or moved in, not on IN_CREATE
+        if mask & (self.IN_CLOSE_WRITE | self.IN_MOVED_TO):
+            self.add_track(dir_path, fn)
+        elif mask & (self.IN_DELETE | self.IN_MOVED_FROM):
+            self.remove_track(dir_path, fn)
+
+    def destroy(self) -> None:
+        super().destroy()
+        with self.fd_lock:
+            if self.stop_w >= 0:
+                os.write(self.stop_w, b'\0')
+
+
+def create_watcher(roots: list, formats: list, tracks: list, on_change: any, recursive: bool = True,
+                   interval: float = 5.0) -> BaseWatcher:
+    if sys.platform.startswith('linux'):
+        try:
+            watcher = InotifyWatcher(roots, formats, tracks, on_change, recursive)
+            watcher.start()
+            return watcher
+        except (OSError, AttributeError, RuntimeError) as _err:
+            log.warn('Inotify is not available, falling back to polling:', _err)
+    watcher = PollWatcher(roots, formats, tracks, on_change, recursive, interval)
+    watcher.start()
+    return watcher
@@ -0,0 +1,220 @@
+import os
+import array
+import itertools
+import marshal
+import random
+import collections
+import log
+import track_table
+
+
+class FenwickTree:
+    def __init__(self, values: any = ()) -> None:
+        self.values = array.array('d', values)
+        # 1-based, tree[i] holds the sum of values (i - lowbit(i), i], built from prefix sums in O(n)
+        prefix = array.array('d', itertools.accumulate(self.values, initial=0.0))
+        self.tree = array.array('d', [prefix[_i] - prefix[_i - (_i & -_i)] for _i in range(len(prefix))])
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+    def add(self, i: int, delta: float) -> None:
+        self.values[i] += delta
+        size = len(self.values)
+        tree = self.tree
+        i += 1
+        while i <= size:
+            tree[i] += delta
+            i += i & -i
+
+    def set(self, i: int, value: float) -> None:
+        self.add(i, value - self.values[i])
+
+    def prefix(self, count: int) -> float:
+        result = 0.0
+        tree = self.tree
+        while count > 0:
+            result += tree[count]
+            count -= count & -count
+        return result
+
+    def total(self) -> float:
+        return self.prefix(len(self.values))
+
+    def append(self, value: float) -> None:
+        size = len(self.values) + 1
+        self.values.append(value)
+        self.tree.append(value + self.prefix(size - 1) - self.prefix(size - (size & -size)))
+
+    def find(self, target: float) -> int:
+        # Index of the value where the running sum passes target
+        size = len(self.values)
+        tree = self.tree
+        pos = 0
+        step = 1 << (size.bit_length() - 1) if size else 0
+        while step:
+            if pos + step <= size and tree[pos + step] <= target:
+                pos += step
+                target -= tree[pos]
+            step >>= 1
+        # Float error can land on the end or on a zero weight right after the last positive one
+        while pos > 0 and (pos >= size or not self.values[pos] > 0):
+            pos -= 1
+        return pos
+
+
+class TrackWeights:
+    def __init__(self, fp: str, recent_window: int = 50, recent_factor: float = 0.05) -> None:
+        self.fp = fp
+        self.version = 2
+        self.recent_window = recent_window
+        self.recent_factor = recent_factor
+        # path -> [skips, rating], only for tracks that have any
+        self.stats = {}
+        self.recent = collections.deque()
+        # path -> [index in tracks, times in the recent deque]
+        self.recent_ids = {}
+        self.tracks = array.array('I')
+        self.table = track_table.TrackTable()
+        # Track ID -> index in tracks, so ratings and skips of any track reach the tree
+        self.positions = array.array('i')
+        self.tree = FenwickTree()
+        self.dirty = False
+        if not os.path.isfile(self.fp):
+            return
+        # Marshal only holds plain data like the library index, anything odd in the file means empty stats
+        try:
+            f = open(self.fp, 'rb')
+            try:
+                content = marshal.load(f)
+            finally:
+                f.close()
+            if not isinstance(content, dict) or not content.get('version') == self.version:
+                raise ValueError('Unknown format')
+            stats = content['stats']
+            recent = content['recent']
+            if not isinstance(stats, dict) or not isinstance(recent, list):
+                raise ValueError('Bad stats')
+            for fp, track_stats in stats.items():
+                if not (isinstance(fp, str) and isinstance(track_stats, tuple) and len(track_stats) == 2 and
+                        all(type(_value) is int for _value in track_stats)):
+                    raise ValueError('Bad stats')
+            if not all(isinstance(_fp, str) for _fp in recent):
+                raise ValueError('Bad recent tracks')
+        except Exception as _err:
+            log.warn('Failed to load track weights:', _err)
+            return
+        self.stats = stats
+        self.recent.extend(recent[-self.recent_window:])
+
+    def save(self) -> None:
+        if not self.dirty:
+            return
+        try:
+            f = open(self.fp + '.tmp', 'wb')
+            marshal.dump({'version': self.version, 'stats': self.stats, 'recent': list(self.recent)}, f)
+            f.close()
+            os.replace(self.fp + '.tmp', self.fp)
+        except OSError as _err:
+            log.warn('Failed to save track weights:', _err)
+            return
+        self.dirty = False
+
+    def weight(self, fp: str) -> float:
+        skips, rating = self.stats.get(fp) or (0, 0)
+        # Unrated tracks count as 3 out of 5, every skip makes a track less likely
+        result = (rating / 3 if rating else 1.0) / (1 + skips)
+        if fp in self.recent_ids:
+            result *= self.recent_factor
+        return result
+
+    def rebuild(self, tracks: array.array, table: track_table.TrackTable) -> None:
+        # Indices change on rescan and compaction, so this is the only O(n) step
+        self.tracks = tracks
+        self.table = table
+        self.positions = array.array('i', [-1]) * len(table)
+        for i, track_id in enumerate(tracks):
+            self.positions[track_id] = i
+        self.recent_ids = {fp: [-1, 0] for fp in self.recent}
+        for fp in self.recent:
+            self.recent_ids[fp][1] += 1
+        # Most tracks have the default weight, so only look at the ones with stats
+        special = {}
+        for fp in itertools.chain(self.stats, self.recent_ids):
+            track_id = table.find(fp)
+            if track_id >= 0:
+                special[track_id] = fp
+        values = array.array('d', [1.0]) * len(tracks)
+        if special:
+            for i, track_id in enumerate(tracks):
+                fp = special.get(track_id)
+                if fp is None:
+                    continue
+                if fp in self.recent_ids:
+                    self.recent_ids[fp][0] = i
+                values[i] = self.weight(fp)
+        self.tree = FenwickTree(values)
+
+    def append(self, fp: str) -> None:
+        # The track is already appended to the shared tracks array
+        track_id = self.tracks[len(self.tree)]
+        if track_id >= len(self.positions):
+            self.positions.extend(array.array('i', [-1]) * (track_id + 1 - len(self.positions)))
+        self.positions[track_id] = len(self.tree)
+        self.tree.append(self.weight(fp))
+
+    def update(self, fp: str) -> None:
+        # Skips are of the current track, it's recent and its index is known, other tracks are looked up
+        recent_id = self.recent_ids.get(fp)
+        if recent_id and recent_id[0] >= 0:
+            i = recent_id[0] if self.positions[self.tracks[recent_id[0]]] == recent_id[0] else -1
+        else:
+            track_id = self.table.find(fp)
+            i = self.positions[track_id] if 0 <= track_id < len(self.positions) else -1
+        if i >= 0:
+            self.tree.set(i, self.weight(fp))
+
+    def pick(self) -> int:
+        total = self.tree.total()
+        if not total > 0:
+            return -1
+        i = self.tree.find(random.random() * total)
+        self.mark_recent(i)
+        return i
+
+    def drop(self, i: int) -> None:
+        self.positions[self.tracks[i]] = -1
+        self.tree.set(i, 0.0)
+
+    def mark_recent(self, i: int) -> None:
+        fp = self.table.path(self.tracks[i])
+        if fp in self.recent_ids:
+            self.recent_ids[fp][1] += 1
+        else:
+            self.recent_ids[fp] = [i, 1]
+        self.recent.append(fp)
+        self.tree.set(i, self.weight(fp))
+        self.dirty = True
+        while len(self.recent) > self.recent_window:
+            old_fp = self.recent.popleft()
+            old_id = self.recent_ids[old_fp]
+            old_id[1] -= 1
+            if not old_id[1]:
+                del self.recent_ids[old_fp]
+                if old_id[0] >= 0:
+                    self.tree.set(old_id[0], self.weight(old_fp))
+
+    def skip(self, fp: str) -> None:
+        skips, rating = self.stats.get(fp) or (0, 0)
+        self.stats[fp] = (skips + 1, rating)
+        self.dirty = True
+        self.update(fp)
+
+    def rate(self, fp: str, rating: int) -> None:
+        skips, _rating = self.stats.get(fp) or (0, 0)
+        if skips or rating:
+            self.stats[fp] = (skips, rating)
+        else:
+            self.stats.pop(fp, None)
+        self.dirty = True
+        self.update(fp)